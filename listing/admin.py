@@ -4,35 +4,123 @@ from importlib import import_module
 from django import forms
 from django.conf import settings
 from django.contrib import admin
+from django.conf.urls import url
 from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import PermissionDenied
+from django.db.models.signals import post_delete, post_migrate, post_save
+from django.dispatch import receiver
+from django.http import HttpResponseBadRequest, JsonResponse
 from django.utils.safestring import mark_safe
+try:
+    from django.urls import reverse_lazy
+except ImportError:
+    from django.core.urlresolvers import reverse_lazy
 from django.utils.translation import ugettext_lazy as _
 
 from sites_groups.widgets import SitesGroupsWidget
 from jmbo.models import ModelBase
 
-from listing.models import Listing, ListingContent, ListingPinned
-from listing.styles import LISTING_CLASSES, LISTING_MAP
+from listing.models import Listing, ListingContent, ListingPinned, \
+    _get_slug_conflict
+from listing.pagination import paginate
+from listing.styles import LISTING_CLASSES, LISTING_MAP, StyleChoices
+from listing.widgets import ItemSelectWidget, \
+    OrderedModelMultipleChoiceField, get_item_label
+
+
+# Number of items per page of search results
+SEARCH_LIMIT = 20
+
+
+# The vocabularies of the form are computed once per process
+_vocabularies = {}
+
+
+def get_content_type_ids():
+    """Return the ids of the content types of ModelBase subclasses"""
+    if "content_types" not in _vocabularies:
+        ids = []
+        for obj in ContentType.objects.all():
+            if (obj.model_class() is not None) \
+                and issubclass(obj.model_class(), ModelBase):
+                ids.append(obj.id)
+        _vocabularies["content_types"] = ids
+    return _vocabularies["content_types"]
+
+
+@receiver(post_save, sender=ContentType)
+@receiver(post_delete, sender=ContentType)
+@receiver(post_migrate)
+def on_content_types_changed(sender, **kwargs):
+    # Migrations create content types without sending post_save
+    _vocabularies.pop("content_types", None)
+
+
+def get_style_choices():
+    """Return the style choices with a preview image. They are rebuilt when
+    a style is registered."""
+    key = (tuple(LISTING_CLASSES), settings.STATIC_URL)
+    cached = _vocabularies.get("styles")
+    if (cached is not None) and (cached[0] == key):
+        return cached[1]
+
+    choices = []
+    for kls in LISTING_CLASSES:
+        image_path = getattr(kls, "image_path", None)
+        image_markup = ""
+        if image_path:
+            image_markup = \
+                "<img src=\"%s%s\" style=\"max-width: 128px;\" />" \
+                    % (settings.STATIC_URL.rstrip("/"), image_path)
+        choices.append((
+            kls.__name__,
+            mark_safe("%s%s" % (image_markup, kls.__name__))
+        ))
+    _vocabularies["styles"] = (key, choices)
+    return choices
+
+
+def formfield_callback(field, **kwargs):
+    # The style field is declared on the form
+    if field.name == "style":
+        return None
+    return field.formfield(**kwargs)
 
 
 class ListingAdminForm(forms.ModelForm):
+    formfield_callback = formfield_callback
 
-    # Content and pinned fields use "through" and require manual handling
-    content_helper = forms.models.ModelMultipleChoiceField(
+    # Content and pinned fields use "through" and require manual handling.
+    # The widgets only load the selected items and search for others.
+    content_helper = OrderedModelMultipleChoiceField(
         label=_("Content"),
-        queryset=ModelBase.objects.all().order_by("title"),
+        queryset=ModelBase.objects.all(),
         required=False,
+        widget=ItemSelectWidget(
+            search_url=reverse_lazy("admin:listing_listing_search")
+        ),
         help_text=_("Individual items to display. Setting this will ignore \
 any setting for <i>Content Type</i>, <i>Categories</i> and <i>Tags</i>."),
     )
-    pinned_helper = forms.models.ModelMultipleChoiceField(
+    pinned_helper = OrderedModelMultipleChoiceField(
         label=_("Pinned"),
-        queryset=ModelBase.objects.all().order_by("title"),
+        queryset=ModelBase.objects.all(),
         required=False,
+        widget=ItemSelectWidget(
+            search_url=reverse_lazy("admin:listing_listing_search")
+        ),
         help_text=_("Individual items to pin to the top of the listing. These \
 items are visible across all pages when navigating the listing."),
     )
 
+    # Declared so the choices are only evaluated when the form is used. This
+    # avoids discovering the styles when the admin is loaded.
+    style = forms.ChoiceField(
+        label=_("Style"),
+        choices=StyleChoices,
+        widget=forms.widgets.RadioSelect
+    )
+
     class Meta:
         model = Listing
         fields = (
@@ -51,50 +139,46 @@ items are visible across all pages when navigating the listing."),
         # Initial through values must be set here else the widgets get the
         # initial order wrong.
         instance = kwargs.get("instance")
-        if instance:
+        # Listings define __len__ so an empty listing is falsy
+        if instance is not None:
             if not "initial" in kwargs:
                 kwargs["initial"] = {}
-            kwargs["initial"]["content_helper"] = \
-                [o.modelbase_obj for o in ListingContent.objects.filter(
-                    listing=instance).order_by("position")]
-            kwargs["initial"]["pinned_helper"] = \
-                [o.modelbase_obj for o in ListingPinned.objects.filter(
-                    listing=instance).order_by("position")]
+            kwargs["initial"]["content_helper"] = list(
+                ListingContent.objects.filter(listing=instance).order_by(
+                    "position"
+                ).values_list("modelbase_obj_id", flat=True)
+            )
+            kwargs["initial"]["pinned_helper"] = list(
+                ListingPinned.objects.filter(listing=instance).order_by(
+                    "position"
+                ).values_list("modelbase_obj_id", flat=True)
+            )
 
         super(ListingAdminForm, self).__init__(*args, **kwargs)
 
         # Limit content_types vocabulary. Cannot do it with limit_choices_to.
-        ids = []
-        for obj in ContentType.objects.all():
-            if (obj.model_class() is not None) and issubclass(obj.model_class(), ModelBase):
-               ids.append(obj.id)
-        self.fields["content_types"]._set_queryset(ContentType.objects.filter(id__in=ids).order_by("model"))
+        self.fields["content_types"]._set_queryset(
+            ContentType.objects.filter(
+                id__in=get_content_type_ids()
+            ).order_by("model")
+        )
 
         # Style
-        choices = []
-        for kls in LISTING_CLASSES:
-            image_path = getattr(kls, "image_path", None)
-            image_markup = ""
-            if image_path:
-                image_markup = \
-                    "<img src=\"%s%s\" style=\"max-width: 128px;\" />" \
-                        % (settings.STATIC_URL.rstrip("/"), image_path)
-            choices.append((
-                kls.__name__,
-                mark_safe("%s%s" % (image_markup, kls.__name__))
-            ))
-        self.fields["style"].widget.choices = choices
+        self.fields["style"].widget.choices = get_style_choices()
 
     def clean(self):
         super(ListingAdminForm, self).clean()
-        for site in self.cleaned_data["sites"]:
-            q = Listing.objects.filter(slug=self.cleaned_data["slug"], sites=site)
-            if self.instance.id:
-                q = q.exclude(id=self.instance.id)
-            if q.exists():
+        sites = self.cleaned_data.get("sites")
+        slug = self.cleaned_data.get("slug")
+        if sites and slug:
+            conflict = _get_slug_conflict(
+                slug, [site.pk for site in sites], self.instance.id
+            )
+            if conflict is not None:
                 raise forms.ValidationError(_(
                     "The slug is already in use by listing %s. To use the same \
-                    slug the listings may not have overlapping sites." % q[0]
+                    slug the listings may not have overlapping sites." \
+                        % conflict.listing
                 ))
         return self.cleaned_data
 
@@ -105,16 +189,8 @@ items are visible across all pages when navigating the listing."),
         old_save_m2m = self.save_m2m
         def save_m2m():
             old_save_m2m()
-            ListingContent.objects.filter(listing=instance).delete()
-            for n, obj in enumerate(self.cleaned_data["content_helper"]):
-                ListingContent.objects.create(
-                    modelbase_obj=obj, listing=instance, position=n
-                )
-            ListingPinned.objects.filter(listing=instance).delete()
-            for n, obj in enumerate(self.cleaned_data["pinned_helper"]):
-                ListingPinned.objects.create(
-                    modelbase_obj=obj, listing=instance, position=n
-                )
+            instance.set_content(self.cleaned_data["content_helper"])
+            instance.set_pinned(self.cleaned_data["pinned_helper"])
         self.save_m2m = save_m2m
 
         if commit:
@@ -143,5 +219,39 @@ class ListingAdmin(admin.ModelAdmin):
     _layout.short_description = "Layout"
     _layout.allow_tags = True
 
+    def get_urls(self):
+        return [
+            url(
+                r"^search/$",
+                self.admin_site.admin_view(self.search_view),
+                name="listing_listing_search"
+            ),
+        ] + super(ListingAdmin, self).get_urls()
+
+    def search_view(self, request):
+        """Return a page of items whose title starts with the q parameter.
+        The match is case sensitive so it can use the pattern index that
+        PostgreSQL has for the title column. A case insensitive match can
+        not."""
+        if not self.has_change_permission(request):
+            raise PermissionDenied
+        queryset = ModelBase.objects.all().only("id", "title", "subtitle")
+        query = request.GET.get("q", "").strip()
+        if query:
+            queryset = queryset.filter(title__startswith=query)
+        try:
+            page = paginate(
+                queryset, ("title", "id"),
+                cursor=request.GET.get("cursor", None), limit=SEARCH_LIMIT
+            )
+        except ValueError:
+            return HttpResponseBadRequest("Invalid cursor")
+        return JsonResponse({
+            "results": [
+                {"id": obj.pk, "text": get_item_label(obj)} for obj in page
+            ],
+            "next_cursor": page.next_cursor
+        })
+
 
 admin.site.register(Listing, ListingAdmin)
@@ -1,11 +1,23 @@
+from django.contrib.sites.shortcuts import get_current_site
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import Q
+from django.http import StreamingHttpResponse
+
 from rest_framework import serializers
 from rest_framework import viewsets
+from rest_framework.exceptions import NotFound, ParseError
 from rest_framework.reverse import reverse
 from rest_framework.response import Response
-from rest_framework.decorators import detail_route
+from rest_framework.decorators import detail_route, list_route
+from rest_framework.utils.urls import replace_query_param
 import rest_framework_extras
 
-from listing.models import Listing, ListingContent, ListingPinned
+from listing.models import Listing, ListingContent, ListingPinned, \
+    ListingSiteSlug, prime_definitions, _get_versions
+from listing.pagination import KeysetPage, decode_cursor, encode_cursor
+from listing.snapshots import load_snapshot
+from listing.utils import listing_condition
 
 
 class ListingSerializer(serializers.HyperlinkedModelSerializer):
@@ -35,6 +47,14 @@ class ListingCreateUpdatePinnedSerializer(
         fields = ("modelbase_obj", "position")
 
 
+def _ordered_objects(li):
+    """Return the items of validated through data sorted by position"""
+    return [
+        di["modelbase_obj"]
+        for di in sorted(li, key=lambda di: di.get("position", 0))
+    ]
+
+
 class ListingCreateUpdateSerializer(serializers.HyperlinkedModelSerializer):
     content = ListingCreateUpdateContentSerializer(many=True, required=False)
     pinned = ListingCreateUpdatePinnedSerializer(many=True, required=False)
@@ -43,6 +63,7 @@ class ListingCreateUpdateSerializer(serializers.HyperlinkedModelSerializer):
         model = Listing
         fields = "__all__"
 
+    @transaction.atomic
     def create(self, validated_data):
         content = validated_data.pop("content", [])
         pinned = validated_data.pop("pinned", [])
@@ -50,39 +71,151 @@ class ListingCreateUpdateSerializer(serializers.HyperlinkedModelSerializer):
             validated_data
         )
 
-        for di in content:
-            di["listing"] = listing
-            ListingContent.objects.create(**di)
-
-        for di in pinned:
-            di["listing"] = listing
-            ListingPinned.objects.create(**di)
+        listing.set_content(_ordered_objects(content))
+        listing.set_pinned(_ordered_objects(pinned))
 
         return listing
 
+    @transaction.atomic
     def update(self, instance, validated_data):
-        content = validated_data.pop("content", [])
-        pinned = validated_data.pop("pinned", [])
+        # A partial update leaves the items that are not passed alone
+        default = None if self.partial else []
+        content = validated_data.pop("content", default)
+        pinned = validated_data.pop("pinned", default)
         listing = super(ListingCreateUpdateSerializer, self).update(
             instance, validated_data
         )
 
-        ListingContent.objects.filter(listing=listing).delete()
-        for di in content:
-            di["listing"] = listing
-            ListingContent.objects.create(**di)
-
-        ListingPinned.objects.filter(listing=listing).delete()
-        for di in pinned:
-            di["listing"] = listing
-            ListingPinned.objects.create(**di)
+        if content is not None:
+            listing.set_content(_ordered_objects(content))
+        if pinned is not None:
+            listing.set_pinned(_ordered_objects(pinned))
 
         return listing
 
 
+class ListingMoveSerializer(ListingCreateUpdateContentSerializer):
+    """A single curated or pinned item and its new position"""
+    pinned = serializers.BooleanField(required=False, default=False)
+
+    class Meta(ListingCreateUpdateContentSerializer.Meta):
+        fields = ("modelbase_obj", "position", "pinned")
+
+
+# Item fields that may be requested with the fields parameter
+SUMMARY_FIELDS = (
+    "id", "title", "subtitle", "slug", "description", "publish_on", "created",
+    "modified", "class_name"
+)
+
+# Upper bound for the limit parameter
+MAX_LIMIT = 100
+
+# Upper bound for the number of listings in a bulk request
+MAX_LISTINGS = 20
+
+
+def _split(value):
+    return [v for v in value.split(",") if v]
+
+
+def _get_fields(request):
+    fields = _split(request.query_params.get("fields", ""))
+    unknown = set(fields) - set(SUMMARY_FIELDS)
+    if unknown:
+        raise ParseError("Unknown fields %s" % ", ".join(sorted(unknown)))
+    return fields
+
+
+def _get_limit(request):
+    value = request.query_params.get("limit", None)
+    if value is None:
+        return None
+    try:
+        limit = int(value)
+    except ValueError:
+        raise ParseError("Invalid limit")
+    if limit < 1:
+        raise ParseError("Invalid limit")
+    return min(limit, MAX_LIMIT)
+
+
+def _get_page(listing, manager, fields, cursor, limit, snapshot=None):
+    """Return a page of items following cursor and rows of the id and the
+    values of fields for each item on the page"""
+    try:
+        if (snapshot is not None) and not fields:
+            # Snapshots only provide the ids
+            page = _paginate_ids(
+                snapshot["items"], cursor,
+                limit or listing.items_per_page or 10
+            )
+            return page, [(pk,) for pk in page]
+        if cursor and (len(decode_cursor(cursor)[0]) == 1):
+            # The cursor of a snapshot page. The live items can not resume
+            # after a bare id, so start at the beginning.
+            cursor = None
+        page = listing.get_page(cursor=cursor, limit=limit, manager=manager)
+    except ValueError:
+        raise NotFound("Invalid cursor")
+    return page, [[obj.pk] + [getattr(obj, f) for f in fields] for obj in page]
+
+
+def _get_item(row, base_url, fields):
+    """Return the URL of an item, or a summary with the URL if there are
+    fields. row starts with the id followed by the values of fields."""
+    url = "%s%s/" % (base_url, row[0])
+    if not fields:
+        return url
+    di = dict(zip(fields, row[1:]))
+    di["url"] = url
+    return di
+
+
+def _stream(rows, base_url, fields):
+    encoder = DjangoJSONEncoder()
+    yield "["
+    for n, row in enumerate(rows):
+        if n:
+            yield ","
+        yield encoder.encode(_get_item(row, base_url, fields))
+    yield "]"
+
+
+def _paginate_ids(ids, cursor, limit):
+    """Paginate a list of ids. The cursor holds the id of the last item
+    served. The cursors of Listing.get_page end with that id too, so paging
+    carries on when a snapshot replaces the live items or the other way
+    around. If the id is not in the list the count of items served is the
+    offset."""
+    start = 0
+    if cursor:
+        values, served = decode_cursor(cursor)
+        if (not values) or (served < 0):
+            raise ValueError("Invalid cursor %s" % cursor)
+        try:
+            last = int(values[-1])
+        except (TypeError, ValueError):
+            raise ValueError("Invalid cursor %s" % cursor)
+        try:
+            start = ids.index(last) + 1
+        except ValueError:
+            start = served
+    if limit < 1:
+        raise ValueError("Invalid limit %s" % limit)
+    end = start + limit
+    page = ids[start:end]
+    next_cursor = None
+    if len(ids) > end:
+        next_cursor = encode_cursor([page[-1]], end)
+    return KeysetPage(page, next_cursor)
+
+
 class ListingObjectsViewSet(viewsets.ModelViewSet):
     queryset = Listing.objects.all()
     serializer_class = ListingSerializer
+    # Manager of the items returned by the bulk action
+    item_manager = "objects"
 
     def get_serializer_class(self):
         if self.action in ("create", "update", "partial_update"):
@@ -90,28 +223,136 @@ class ListingObjectsViewSet(viewsets.ModelViewSet):
         else:
             return ListingSerializer
 
+    def get_object(self):
+        # Needed for the conditional headers and again by the action
+        if not hasattr(self, "_object"):
+            self._object = super(ListingObjectsViewSet, self).get_object()
+        return self._object
+
+    @listing_condition
+    def retrieve(self, request, *args, **kwargs):
+        return super(ListingObjectsViewSet, self).retrieve(
+            request, *args, **kwargs
+        )
+
+    @detail_route(methods=["post"])
+    def move(self, request, pk, **kwargs):
+        """Move a curated item, or a pinned item if pinned is set, to
+        position without passing all the items. The item is added if it is
+        not there yet."""
+        listing = self.get_object()
+        serializer = ListingMoveSerializer(
+            data=request.data, context=self.get_serializer_context()
+        )
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+        move = listing.move_pinned if data["pinned"] else listing.move_content
+        return Response(move(data["modelbase_obj"], data.get("position", 0)))
+
     # Deviate from naming convention because queryset is already taken
     @detail_route(methods=["get"])
+    @listing_condition
     def queryset_objects(self, request, pk, **kwargs):
-        li = []
-        for obj in self.get_object().queryset:
-            # todo :fix this reverse
-            url = "%s%s/" % (reverse("modelbase-list", request=self.request), obj.pk)
-            li.append(url)
-        return Response(li)
+        return self.get_items_response(self.get_object(), manager="objects")
 
     @detail_route(methods=["get"])
+    @listing_condition
     def queryset_permitted(self, request, pk, **kwargs):
-        li = []
-        for obj in self.get_object().queryset_permitted:
-            # todo :fix this reverse
-            url = "%s%s/" % (reverse("modelbase-list", request=self.request), obj.pk)
-            li.append(url)
-        return Response(li)
+        listing = self.get_object()
+        return self.get_items_response(
+            listing, manager="permitted",
+            snapshot=load_snapshot(listing, request=request)
+        )
+
+    @list_route(methods=["get"])
+    def bulk(self, request, **kwargs):
+        """Return the first page of items of each listing given by the ids
+        and slugs parameters. Listings and definitions are looked up in
+        batches and the fields parameter works as for queryset_objects."""
+        ids = _split(request.query_params.get("ids", ""))
+        slugs = _split(request.query_params.get("slugs", ""))
+        if not (ids or slugs):
+            raise ParseError("Pass ids or slugs")
+        if len(ids) + len(slugs) > MAX_LISTINGS:
+            raise ParseError("At most %s listings" % MAX_LISTINGS)
+        try:
+            ids = [int(i) for i in ids]
+        except ValueError:
+            raise ParseError("Invalid ids")
+        fields = _get_fields(request)
+        limit = _get_limit(request)
+        base_url = reverse("modelbase-list", request=request)
+
+        # Slugs are only unique per site
+        listings = list(self.get_queryset().filter(
+            Q(id__in=ids) | Q(id__in=ListingSiteSlug.objects.filter(
+                site=get_current_site(request), slug__in=slugs
+            ).values("listing"))
+        ))
+        # In the order asked for
+        order = dict((v, n) for n, v in enumerate(ids))
+        order.update(dict((v, n + len(ids)) for n, v in enumerate(slugs)))
+        listings.sort(key=lambda l: order.get(l.pk, order.get(l.slug)))
+        prime_definitions(listings)
+        if self.item_manager == "permitted":
+            versions = _get_versions([listing.pk for listing in listings])
+
+        results = []
+        for listing in listings:
+            snapshot = None
+            if self.item_manager == "permitted":
+                snapshot = load_snapshot(
+                    listing, versions[listing.pk], request
+                )
+            page, rows = _get_page(
+                listing, self.item_manager, fields, None, limit, snapshot
+            )
+            results.append({
+                "id": listing.pk,
+                "slug": listing.slug,
+                "next_cursor": page.next_cursor,
+                "results": [_get_item(row, base_url, fields) for row in rows]
+            })
+        return Response({"results": results})
+
+    def get_items_response(self, listing, manager, snapshot=None):
+        """Return a page of item URLs, or summaries if the fields parameter
+        is given. The stream parameter returns all items as a streaming
+        response instead."""
+        request = self.request
+        fields = _get_fields(request)
+        # Reverse once instead of per item
+        base_url = reverse("modelbase-list", request=request)
+
+        if request.query_params.get("stream"):
+            if (snapshot is not None) and not fields:
+                rows = ((pk,) for pk in snapshot["items"])
+            else:
+                rows = listing._get_queryset(manager=manager).values_list(
+                    "id", *fields
+                ).iterator()
+            return StreamingHttpResponse(
+                _stream(rows, base_url, fields), content_type="application/json"
+            )
+
+        page, rows = _get_page(
+            listing, manager, fields, request.query_params.get("cursor", None),
+            _get_limit(request), snapshot
+        )
+        next_url = None
+        if page.has_next:
+            next_url = replace_query_param(
+                request.build_absolute_uri(), "cursor", page.next_cursor
+            )
+        return Response({
+            "next": next_url,
+            "results": [_get_item(row, base_url, fields) for row in rows]
+        })
 
 
 class ListingPermittedViewSet(ListingObjectsViewSet):
     queryset = Listing.permitted.all()
+    item_manager = "permitted"
 
 
 def register(router):
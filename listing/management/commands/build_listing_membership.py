@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from listing.models import Listing
+
+
+class Command(BaseCommand):
+    help = "Build the membership index for all listings."
+
+    def handle(self, *args, **options):
+        for listing in Listing.objects.all():
+            listing.build_membership()
@@ -0,0 +1,49 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from listing.models import Listing
+from listing.snapshots import get_snapshot_dir, write_snapshot
+
+
+class Command(BaseCommand):
+    help = "Write the items of listings to JSON files. Only listings whose \
+version changed are written."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--dir", dest="directory", default=None,
+            help="Target directory. Defaults to the snapshot_dir setting."
+        )
+        parser.add_argument(
+            "--slug", action="append", dest="slugs", default=[],
+            help="Only export the listing with this slug. Repeatable."
+        )
+        parser.add_argument(
+            "--summaries", action="store_true", default=False,
+            help="Include a summary of each item."
+        )
+
+    def handle(self, *args, **options):
+        directory = options["directory"] or get_snapshot_dir()
+        if not directory:
+            raise CommandError(
+                "Pass --dir or set snapshot_dir in the LISTING setting"
+            )
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        listings = Listing.objects.all()
+        if options["slugs"]:
+            listings = listings.filter(slug__in=options["slugs"])
+
+        written = 0
+        for listing in listings:
+            if write_snapshot(
+                listing, directory, summaries=options["summaries"]
+            ):
+                written += 1
+                self.stdout.write("Wrote %s" % listing.slug)
+        self.stdout.write("Wrote %d of %d listings" % (
+            written, len(listings)
+        ))
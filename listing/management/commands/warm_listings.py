@@ -0,0 +1,175 @@
+import time
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+
+from django import template
+from django.conf import settings
+from django.contrib.sites.models import Site
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.test.client import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.utils.module_loading import import_string
+
+from crum import get_current_request, set_current_request
+
+from listing.models import Listing
+from listing.templatetags.listing_tags import render_cached_listing
+
+
+def get_request_middleware():
+    """Return the installed pagination middleware. It gives requests the page
+    attribute or method that pagination templates use."""
+    paths = getattr(settings, "MIDDLEWARE", None) \
+        or getattr(settings, "MIDDLEWARE_CLASSES", ())
+    return [
+        import_string(path)() for path in paths
+        if path.endswith(".PaginationMiddleware")
+    ]
+
+
+def warm(args):
+    """Render the first pages of a listing for each of its sites. Return the
+    listing id, the duration in seconds, the number of queries and an error
+    message or None."""
+    listing_id, site_ids, pages = args
+    factory = RequestFactory()
+    middleware = get_request_middleware()
+    previous = get_current_request()
+    error = None
+    start = time.time()
+    with CaptureQueriesContext(connection) as context:
+        try:
+            listing = Listing.objects.get(id=listing_id)
+            for site in Site.objects.filter(id__in=site_ids):
+                for page in range(1, pages + 1):
+                    request = factory.get(
+                        "/", {"page": page}, HTTP_HOST=site.domain
+                    )
+                    for mw in middleware:
+                        mw.process_request(request)
+                    # The permitted manager finds the site and layer through
+                    # the current request
+                    set_current_request(request)
+                    # Render this listing. Looking it up by slug may find the
+                    # listing of another site.
+                    render_cached_listing(
+                        listing, template.Context({"request": request})
+                    )
+        except Exception as exc:
+            # Report it and carry on with the other listings
+            error = "%s: %s" % (exc.__class__.__name__, exc)
+        finally:
+            set_current_request(previous)
+    return listing_id, time.time() - start, len(context), error
+
+
+def warm_in_pool(args):
+    try:
+        return warm(args)
+    finally:
+        # Pool workers must not hold on to connections
+        connection.close()
+
+
+class Command(BaseCommand):
+    help = "Render listings to populate the listing caches."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--site", type=int, action="append", dest="sites", default=[],
+            help="Only warm listings for this site id. Repeatable."
+        )
+        parser.add_argument(
+            "--style", action="append", dest="styles", default=[],
+            help="Only warm listings with this style. Repeatable."
+        )
+        parser.add_argument(
+            "--slug", action="append", dest="slugs", default=[],
+            help="Only warm the listing with this slug. Repeatable."
+        )
+        parser.add_argument(
+            "--pages", type=int, default=1,
+            help="Number of pages to render for each listing."
+        )
+        parser.add_argument(
+            "--workers", type=int, default=1,
+            help="Number of listings to warm in parallel."
+        )
+        parser.add_argument(
+            "--processes", action="store_true", default=False,
+            help="Use processes instead of threads. Only useful with a cache \
+that is shared across processes."
+        )
+
+    def handle(self, *args, **options):
+        listings = Listing.objects.all()
+        if options["sites"]:
+            listings = listings.filter(sites__in=options["sites"]).distinct()
+        if options["styles"]:
+            listings = listings.filter(style__in=options["styles"])
+        if options["slugs"]:
+            listings = listings.filter(slug__in=options["slugs"])
+
+        # The current site does not depend on the host of the request when
+        # SITE_ID is set, so only that site can be rendered.
+        current = getattr(settings, "SITE_ID", None)
+        if current is not None and set(options["sites"]) - set([current]):
+            raise CommandError(
+                "Only site %s can be warmed since SITE_ID is set" % current
+            )
+
+        site_ids = {}
+        for listing_id, site_id in Listing.sites.through.objects.filter(
+            listing__in=listings
+        ).values_list("listing_id", "site_id"):
+            site_ids.setdefault(listing_id, []).append(site_id)
+        slugs = dict(listings.values_list("id", "slug"))
+        # Listings without sites are rendered for the current site
+        default = [] if options["sites"] else [Site.objects.get_current().pk]
+        jobs = []
+        for pk in sorted(slugs.keys()):
+            ids = [
+                site_id for site_id in site_ids.get(pk, default)
+                if ((not options["sites"]) or (site_id in options["sites"]))
+                and (current is None or site_id == current)
+            ]
+            if ids:
+                jobs.append((pk, ids, options["pages"]))
+
+        start = time.time()
+        if options["workers"] > 1:
+            if options["processes"]:
+                # Children must not inherit the connections of the parent
+                connections.close_all()
+                pool = Pool(options["workers"])
+            else:
+                pool = ThreadPool(options["workers"])
+            results = pool.imap_unordered(warm_in_pool, jobs)
+        else:
+            pool = None
+            results = (warm(job) for job in jobs)
+
+        total = 0
+        failed = 0
+        try:
+            for listing_id, duration, queries, error in results:
+                total += queries
+                if error is not None:
+                    failed += 1
+                    self.stderr.write("%s: failed, %s" % (
+                        slugs[listing_id], error
+                    ))
+                    continue
+                self.stdout.write("%s: %.3fs, %d queries" % (
+                    slugs[listing_id], duration, queries
+                ))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        self.stdout.write("Warmed %d listings in %.3fs, %d queries" % (
+            len(jobs) - failed, time.time() - start, total
+        ))
+        if failed:
+            self.stdout.write("Failed to warm %d listings" % failed)
@@ -1,7 +1,45 @@
 from django.db import models
+from django.db.models import Q
 from django.conf import settings
 
 
+class ListingManager(models.Manager):
+
+    def _get_linked_ids(self, name, values):
+        """Return a subquery of the ids of listings linked to values through
+        the many to many field name."""
+        field = self.model._meta.get_field(name)
+        return field.remote_field.through.objects.filter(**{
+            "%s__in" % field.m2m_reverse_field_name(): values
+        }).values(field.m2m_field_name())
+
+    def affected_by(self, obj):
+        """Return the listings whose items may change when obj, a ModelBase
+        instance, changes. The many to many tables serve as an index so this
+        is a single query without joins."""
+
+        def get_related_ids(name):
+            field = obj._meta.get_field(name)
+            return field.remote_field.through.objects.filter(**{
+                field.m2m_field_name(): obj.pk
+            }).values(field.m2m_reverse_field_name())
+
+        q = Q(id__in=self._get_linked_ids(
+                "content_types", [obj.content_type_id]
+            )) \
+            | Q(id__in=self._get_linked_ids(
+                "categories", get_related_ids("categories")
+            )) \
+            | Q(id__in=self._get_linked_ids("tags", get_related_ids("tags"))) \
+            | Q(id__in=self._get_linked_ids("content", [obj.pk])) \
+            | Q(id__in=self._get_linked_ids("pinned", [obj.pk]))
+        if obj.primary_category_id:
+            q = q | Q(id__in=self._get_linked_ids(
+                "categories", [obj.primary_category_id]
+            ))
+        return self.filter(q)
+
+
 class PermittedManager(models.Manager):
 
     def get_query_set(self):
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 13:55
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('listing', '0002_auto_20171124_1049'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='listingcontent',
+            index_together=set([('listing', 'position')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='listingpinned',
+            index_together=set([('listing', 'position')]),
+        ),
+    ]
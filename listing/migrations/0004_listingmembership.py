@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 13:57
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jmbo', '0003_auto_20160530_1247'),
+        ('listing', '0003_through_position_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ListingMembership',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('publish_on', models.DateTimeField(null=True)),
+                ('created', models.DateTimeField(null=True)),
+                ('listing', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='membership_link_to_listing', to='listing.Listing')),
+                ('modelbase_obj', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='jmbo.ModelBase')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='listingmembership',
+            unique_together=set([('listing', 'modelbase_obj')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='listingmembership',
+            index_together=set([('listing', 'publish_on', 'created')]),
+        ),
+    ]
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 14:33
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def check_conflicts(apps, schema_editor):
+    """Refuse to migrate if listings already share a slug on a site. The old
+    check could be bypassed. There is no right listing to keep the slug."""
+    Listing = apps.get_model("listing", "Listing")
+    listings = {}
+    for listing_id, slug, site_id in Listing.sites.through.objects.order_by(
+        "listing_id", "site_id"
+    ).values_list("listing_id", "listing__slug", "site_id"):
+        listings.setdefault((site_id, slug), []).append(listing_id)
+    conflicts = [
+        "slug %s on site %s: listings %s" % (
+            slug, site_id, ", ".join(["%s" % pk for pk in ids])
+        )
+        for (site_id, slug), ids in sorted(listings.items()) if len(ids) > 1
+    ]
+    if conflicts:
+        raise RuntimeError(
+            "Listings share a slug on a site. Change the slugs or sites of \
+these listings and migrate again. %s" % "; ".join(conflicts)
+        )
+
+
+def populate(apps, schema_editor):
+    Listing = apps.get_model("listing", "Listing")
+    ListingSiteSlug = apps.get_model("listing", "ListingSiteSlug")
+    ListingSiteSlug.objects.bulk_create([
+        ListingSiteSlug(listing_id=listing_id, site_id=site_id, slug=slug)
+        for listing_id, slug, site_id in Listing.sites.through.objects.values_list(
+            "listing_id", "listing__slug", "site_id"
+        )
+    ], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sites', '0002_alter_domain_unique'),
+        ('listing', '0004_listingmembership'),
+    ]
+
+    operations = [
+        migrations.RunPython(check_conflicts, migrations.RunPython.noop),
+        migrations.CreateModel(
+            name='ListingSiteSlug',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('slug', models.SlugField(max_length=32)),
+                ('listing', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='site_slugs', to='listing.Listing')),
+                ('site', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='sites.Site')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='listingsiteslug',
+            unique_together=set([('listing', 'site'), ('site', 'slug')]),
+        ),
+        migrations.RunPython(populate, migrations.RunPython.noop),
+    ]
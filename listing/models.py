@@ -1,7 +1,13 @@
-from django.db import models, connection
-from django.db.models import Q
-from django.db.models.signals import m2m_changed
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, models, transaction
+from django.db.models import Case, F, Q, Value, When
+from django.db.models.signals import m2m_changed, post_save, post_delete, \
+    pre_delete, pre_save
 from django.dispatch import receiver
+from django.utils import timezone
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes.fields import GenericForeignKey
 try:
@@ -9,41 +15,20 @@ try:
 except ImportError:
     from django.core.urlresolvers import reverse
 
+from category.models import Category, Tag
 from jmbo.models import ModelBase
 
-from listing.styles import LISTING_CLASSES
-from listing.managers import PermittedManager
+from listing.styles import StyleChoices
+from listing.managers import ListingManager, PermittedManager
+from listing.pagination import paginate
+from listing.utils import AsyncIterator, run_in_executor
 
 
-class AttributeWrapper:
-    """Wrapper that allows attributes to be added or overridden on an object"""
+# Definitions are invalidated explicitly. The timeout is a safety net.
+DEFINITION_TIMEOUT = 86400
 
-    def __init__(self, obj, **kwargs):
-        self._obj = obj
-        self._attributes = {}
-        for k, v in kwargs.items():
-            self._attributes[k] = v
-
-    def __getattr__(self, key):
-        if key in self._attributes:
-            return self._attributes[key]
-        return getattr(self._obj, key)
-
-    def __setstate__(self, dict):
-        self.__dict__.update(dict)
-
-    def __len__(self):
-        return len(self._obj)
-
-    def __iter__(self):
-        for obj in self._obj:
-            yield obj
-
-    @property
-    def klass(self):
-        """Can"t override __class__ and making it a property also does not
-        work. Could be because of Django metaclasses."""
-        return self._obj.__class__
+# Number of rows repositioned per query by Listing._set_through
+SET_THROUGH_BATCH_SIZE = 100
 
 
 class Listing(models.Model):
@@ -102,7 +87,7 @@ items are visible across all pages when navigating the listing.""",
 Set to zero to display all items.""",
     )
     style = models.CharField(
-        choices=[(klass.__name__, klass.__name__) for klass in LISTING_CLASSES],
+        choices=StyleChoices(),
         max_length=64
     )
     items_per_page = models.PositiveIntegerField(
@@ -115,7 +100,7 @@ Set to zero to display all items.""",
         help_text="Sites that this listing will appear on.",
     )
 
-    objects = models.Manager()
+    objects = ListingManager()
     permitted = PermittedManager()
 
     class Meta:
@@ -127,51 +112,130 @@ Set to zero to display all items.""",
         else:
             return self.title
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Listing, cls).from_db(db, field_names, values)
+        # Remember the stored slug so saving can tell if it changed. A
+        # deferred slug is not loaded for this.
+        instance._listing_slug = instance.__dict__.get("slug", None)
+        return instance
+
     def get_absolute_url(self):
         #return reverse("listing-detail", args=[self.slug])
         # todo: fix
         return ""
 
-    def _get_queryset(self, manager="objects"):
-        # Due to the workaround we're not always returning a real queryset.
-        content = self._get_content_queryset(manager=manager)
-        if content:
-            return content
+    @property
+    def definition(self):
+        """Ids of the related objects and the values that define this
+        listing. It is cached so using a listing does not query its
+        configuration tables."""
+        if getattr(self, "_definition", None) is None:
+            key = _get_definition_key(self.pk)
+            definition = cache.get(key)
+            if definition is None:
+                definition = self._build_definition()
+                cache.set(key, definition, DEFINITION_TIMEOUT)
+            self._definition = definition
+        return self._definition
+
+    def _build_definition(self):
+        return _build_definitions([self])[self.pk]
+
+    @property
+    def version(self):
+        """A value that changes whenever the items of the listing may change.
+        Use it to build cache keys."""
+        return _get_version(self.pk)
 
+    @property
+    def last_modified(self):
+        """When the version of the listing last changed, for Last-Modified
+        headers. Unknown times are reported as now."""
+        return _get_last_modified(self.pk)
+
+    def invalidate(self):
+        """Discard the cached definition and everything derived from it"""
+        _invalidate_listings([self.pk])
+        self._definition = None
+
+    def _get_rule_queryset(self, manager="objects"):
+        """Items matching the content type, category and tag criteria. The
+        result may contain duplicates."""
+        definition = self.definition
         q = getattr(ModelBase, manager).all()
         one_match = False
-        if self.content_types.exists():
-            q = q.filter(content_type__in=self.content_types.all())
+        if definition["content_types"]:
+            q = q.filter(content_type__in=definition["content_types"])
             one_match = True
-        if self.categories.exists():
-            q1 = Q(primary_category__in=self.categories.all())
-            q2 = Q(categories__in=self.categories.all())
+        if definition["categories"]:
+            q1 = Q(primary_category__in=definition["categories"])
+            q2 = Q(categories__in=definition["categories"])
             q = q.filter(q1|q2)
             one_match = True
-        if self.tags.exists():
-            q = q.filter(tags__in=self.tags.all())
+        if definition["tags"]:
+            q = q.filter(tags__in=definition["tags"])
             one_match = True
         if not one_match:
             q = ModelBase.objects.none()
         # todo: use manager below
-        q = q.exclude(id__in=self.pinned.all())
-
-        # Ensure there are no duplicates. Oracle bugs and SQLite definciencies
-        # require special handling around distinct which incur a performance
-        # penalty when fetching attributes. Avoid the penalty for other
-        # databases by doing database detection.
-        if connection.vendor.lower() in ("oracle", "sqlite"):
-            q = q.only("id").distinct()
-        else:
-            q = q.distinct("publish_on", "created", "id").order_by(
-                "-publish_on", "-created"
+        return q
+
+    def _get_search_queryset(self, manager="objects"):
+        """Items found by the criteria without any limit on the count"""
+        if _membership_index_enabled():
+            # The index is already free of duplicates
+            return getattr(ModelBase, manager).filter(
+                listingmembership__listing=self
+            ).exclude(id__in=self.definition["pinned"]).order_by(
+                "-listingmembership__publish_on",
+                "-listingmembership__created",
+                "-id"
             )
 
+        q = self._get_rule_queryset(manager=manager).exclude(
+            id__in=self.definition["pinned"]
+        )
+
+        # Remove duplicates with a semi-join instead of distinct. Distinct
+        # needs workarounds on Oracle and SQLite which defer fields, while
+        # this yields fully loaded and ordered items on all databases.
+        return ModelBase.objects.filter(id__in=q.values("id")).order_by(
+            "-publish_on", "-created", "-id"
+        )
+
+    def _get_queryset(self, manager="objects"):
+        if self.definition["content"]:
+            content = self._get_content_queryset(manager=manager)
+            if content.exists():
+                return content
+
+        q = self._get_search_queryset(manager=manager)
         if self.count:
             q = q[:self.count]
 
         return q
 
+    def get_page(self, cursor=None, limit=None, manager="permitted"):
+        """Return a page of items following cursor. Unlike offset based
+        paging the cost of a page does not depend on how deep it is."""
+        limit = limit or self.items_per_page or 10
+        content = self._get_content_queryset(manager=manager)
+        if self.definition["content"] and content.exists():
+            return paginate(
+                content.annotate(listing_position=F("listingcontent__position")),
+                ("listing_position", "id"),
+                cursor=cursor,
+                limit=limit
+            )
+        return paginate(
+            self._get_search_queryset(manager=manager),
+            ("-publish_on", "-created", "-id"),
+            cursor=cursor,
+            limit=limit,
+            count=self.count
+        )
+
     @property
     def queryset(self):
         return self._get_queryset()
@@ -181,27 +245,136 @@ Set to zero to display all items.""",
         return self._get_queryset(manager="permitted")
 
     def set_pinned(self, iterable):
-        for n, obj in enumerate(iterable):
-            ListingPinned.objects.create(
-                modelbase_obj=obj, listing=self, position=n
-            )
+        """Pin the items in iterable in that order. See _set_through."""
+        return self._set_through(ListingPinned, iterable)
 
     def set_content(self, iterable):
-        for n, obj in enumerate(iterable):
-            ListingContent.objects.create(
-                modelbase_obj=obj, listing=self, position=n
+        """Set the curated items to those in iterable in that order. See
+        _set_through."""
+        return self._set_through(ListingContent, iterable)
+
+    def move_pinned(self, obj, position):
+        """Move the pinned item obj to position. See _move_through."""
+        return self._move_through(ListingPinned, obj, position)
+
+    def move_content(self, obj, position):
+        """Move the curated item obj to position. See _move_through."""
+        return self._move_through(ListingContent, obj, position)
+
+    def _move_through(self, through, obj, position):
+        """Move the item or id obj to position, adding it if it is not there
+        yet. The other items keep their order. See _set_through."""
+        pk = getattr(obj, "pk", obj)
+        with transaction.atomic():
+            ids = [
+                i for i in through.objects.filter(listing=self).order_by(
+                    "position", "id"
+                ).select_for_update().values_list("modelbase_obj_id", flat=True)
+                if i != pk
+            ]
+            ids.insert(position, pk)
+            return self._set_through(through, ids)
+
+    def _set_through(self, through, iterable):
+        """Make the through rows match the ordered items or ids in iterable.
+        Only the difference is written with at most one delete, one insert and
+        a few updates. Return a dictionary with the ids of the items that were
+        added, removed and moved."""
+        ids = []
+        positions = {}
+        for obj in iterable:
+            pk = getattr(obj, "pk", obj)
+            if pk not in positions:
+                positions[pk] = len(ids)
+                ids.append(pk)
+
+        added = []
+        removed = []
+        moved = []
+        with transaction.atomic():
+            rows = {}
+            stale = []
+            for row_id, pk, position in through.objects.filter(
+                listing=self
+            ).order_by("position", "id").values_list(
+                "id", "modelbase_obj_id", "position"
+            ).select_for_update():
+                if (pk not in positions) or (pk in rows):
+                    # Removed items and legacy duplicates
+                    stale.append(row_id)
+                    if (pk not in positions) and (pk not in removed):
+                        removed.append(pk)
+                    continue
+                rows[pk] = row_id
+                if position != positions[pk]:
+                    moved.append(pk)
+
+            if stale:
+                through.objects.filter(id__in=stale).delete()
+
+            # bulk_update is not available on all supported Django versions.
+            # Batch to stay clear of the SQLite variable limit.
+            for n in range(0, len(moved), SET_THROUGH_BATCH_SIZE):
+                batch = moved[n:n + SET_THROUGH_BATCH_SIZE]
+                through.objects.filter(
+                    id__in=[rows[pk] for pk in batch]
+                ).update(position=Case(
+                    *[When(id=rows[pk], then=Value(positions[pk]))
+                        for pk in batch],
+                    output_field=models.PositiveIntegerField()
+                ))
+
+            added = [pk for pk in ids if pk not in rows]
+            through.objects.bulk_create([
+                through(listing=self, modelbase_obj_id=pk, position=positions[pk])
+                for pk in added
+            ])
+
+        # Bulk operations do not send signals. Leave the version and the
+        # caches derived from it alone if nothing changed.
+        if stale or moved or added:
+            self.invalidate()
+        return {"added": added, "removed": removed, "moved": moved}
+
+    def build_membership(self):
+        """Bring the membership index for this listing up to date"""
+        links = ListingMembership.objects.filter(listing=self)
+        rules = self._get_rule_queryset()
+        with transaction.atomic():
+            links.exclude(modelbase_obj__in=rules.values("id")).delete()
+            ListingMembership.objects.bulk_create([
+                ListingMembership(
+                    listing=self, modelbase_obj_id=pk, publish_on=publish_on,
+                    created=created
+                ) for pk, publish_on, created in rules.exclude(
+                    id__in=links.values("modelbase_obj")
+                ).values_list("id", "publish_on", "created").distinct()
+            ])
+
+    def update_membership(self, obj):
+        """Add, update or remove a single item in the membership index"""
+        links = ListingMembership.objects.filter(
+            listing=self, modelbase_obj_id=obj.id
+        )
+        if self._get_rule_queryset().filter(id=obj.id).exists():
+            updated = links.update(
+                publish_on=obj.publish_on, created=obj.created
             )
+            if not updated:
+                ListingMembership.objects.create(
+                    listing=self, modelbase_obj_id=obj.id,
+                    publish_on=obj.publish_on, created=obj.created
+                )
+        else:
+            links.delete()
 
     def _get_content_queryset(self, manager="objects"):
-        # I can't find a way to do this in a single query. Note we return an
-        # emulated queryset.
-        li = [o for o in getattr(ModelBase, manager).filter(listing_content=self)\
-            .exclude(id__in=self.pinned.all())]
-        order = [o.modelbase_obj.id for o in ListingContent.objects.filter(
-            listing=self).order_by("position")]
-        #li.sort(lambda a, b: cmp(order.index(a.id), order.index(b.id)))
-        li.sort(key=lambda item: order.index(item.id))
-        return AttributeWrapper(li, exists=len(li))
+        # Join on the through model so the database does the ordering
+        return getattr(ModelBase, manager).filter(
+            listingcontent__listing=self
+        ).exclude(
+            id__in=self.definition["pinned"]
+        ).order_by("listingcontent__position", "id")
 
     @property
     def content_queryset(self):
@@ -212,14 +385,9 @@ Set to zero to display all items.""",
         return self._get_content_queryset(manager="permitted")
 
     def _get_pinned_queryset(self, manager="objects"):
-        # I can't find a way to do this in a single query. Note we return an
-        # emulated queryset.
-        li = [o for o in getattr(ModelBase, manager).filter(listing_pinned=self)]
-        order = [o.modelbase_obj.id for o in ListingPinned.objects.filter(
-            listing=self).order_by("position")]
-        #li.sort(lambda a, b: cmp(order.index(a.id), order.index(b.id)))
-        li.sort(key=lambda item: order.index(item.id))
-        return AttributeWrapper(li, exists=len(li))
+        return getattr(ModelBase, manager).filter(
+            listingpinned__listing=self
+        ).order_by("listingpinned__position")
 
     @property
     def pinned_queryset(self):
@@ -234,8 +402,45 @@ Set to zero to display all items.""",
             yield obj
 
     def __len__(self):
-        # We can't use count because it's not a real queryset
-        return len(self.queryset_permitted)
+        return self.queryset_permitted.count()
+
+    def __bool__(self):
+        return self.exists()
+
+    __nonzero__ = __bool__
+
+    def exists(self):
+        """Return whether the listing has any permitted items without fetching
+        them."""
+        return self.queryset_permitted.exists()
+
+    # Asynchronous counterparts. The queries run in an executor so that
+    # several listings can be fetched concurrently with asyncio.gather.
+
+    def aqueryset(self, manager="permitted"):
+        """Return an awaitable for the list of items"""
+        return run_in_executor(
+            lambda: list(self._get_queryset(manager=manager))
+        )
+
+    def acontent(self, manager="permitted"):
+        """Return an awaitable for the list of curated items"""
+        return run_in_executor(
+            lambda: list(self._get_content_queryset(manager=manager))
+        )
+
+    def apinned(self, manager="permitted"):
+        """Return an awaitable for the list of pinned items"""
+        return run_in_executor(
+            lambda: list(self._get_pinned_queryset(manager=manager))
+        )
+
+    def acount(self):
+        """Return an awaitable for len(listing)"""
+        return run_in_executor(len, self)
+
+    def __aiter__(self):
+        return AsyncIterator(lambda: list(self.queryset_permitted))
 
 
 class ListingContent(models.Model):
@@ -250,6 +455,9 @@ class ListingContent(models.Model):
     )
     position = models.PositiveIntegerField(default=0)
 
+    class Meta:
+        index_together = (("listing", "position"),)
+
 
 class ListingPinned(models.Model):
     """Through model to facilitate ordering"""
@@ -260,16 +468,509 @@ class ListingPinned(models.Model):
     )
     position = models.PositiveIntegerField(default=0)
 
+    class Meta:
+        index_together = (("listing", "position"),)
+
+
+class ListingMembership(models.Model):
+    """Precomputed rule based membership of a listing. The publish_on and
+    created values of the item are copied to allow an indexed sort."""
 
-@receiver(m2m_changed)
-def check_slug(sender, **kwargs):
-    """Slug must be unique per site"""
+    modelbase_obj = models.ForeignKey(
+        "jmbo.ModelBase", on_delete=models.CASCADE
+    )
+    listing = models.ForeignKey(
+        Listing, related_name="membership_link_to_listing",
+        on_delete=models.CASCADE
+    )
+    publish_on = models.DateTimeField(null=True)
+    created = models.DateTimeField(null=True)
+
+    class Meta:
+        unique_together = (("listing", "modelbase_obj"),)
+        index_together = (("listing", "publish_on", "created"),)
+
+
+class ListingSiteSlug(models.Model):
+    """The slug of a listing for each of its sites. It lets the database
+    enforce that a slug is unique per site."""
+
+    listing = models.ForeignKey(
+        Listing, related_name="site_slugs", on_delete=models.CASCADE
+    )
+    site = models.ForeignKey("sites.Site", on_delete=models.CASCADE)
+    slug = models.SlugField(max_length=32)
+
+    class Meta:
+        unique_together = (("site", "slug"), ("listing", "site"))
+
+
+def _get_definition_key(pk):
+    return "listing-definition-%s" % pk
+
+
+def _on_commit(func):
+    """Call func now and again once the transaction commits. A request that
+    reads the old rows before the commit may cache state derived from them
+    in between."""
+    func()
+    if transaction.get_connection().in_atomic_block:
+        transaction.on_commit(func)
+
+
+def _invalidate_listings(pks):
+    """Discard the cached definitions of listings and bump their versions"""
+    pks = list(pks)
+    _on_commit(
+        lambda: cache.delete_many([_get_definition_key(pk) for pk in pks])
+    )
+    _bump_versions(pks)
+
+
+def _get_version_key(pk):
+    return "listing-version-%s" % pk
+
+
+def _new_version():
+    # Larger than any version handed out before the counter was evicted
+    return int(time.time() * 1000000)
+
+
+def _get_version(pk):
+    """Return a value that changes whenever the items of the listing may
+    change. Versions are kept in the cache and never expire."""
+    key = _get_version_key(pk)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, _new_version(), None)
+        version = cache.get(key)
+    return version
+
+
+def _get_versions(pks):
+    """Return the versions of many listings by id with one cache lookup"""
+    keys = dict((_get_version_key(pk), pk) for pk in pks)
+    cached = cache.get_many(list(keys.keys()))
+    versions = dict((keys[key], version) for key, version in cached.items())
+    for pk in pks:
+        if pk not in versions:
+            versions[pk] = _get_version(pk)
+    return versions
+
+
+def _get_modified_key(pk):
+    return "listing-modified-%s" % pk
+
+
+def _get_last_modified(pk):
+    key = _get_modified_key(pk)
+    last_modified = cache.get(key)
+    if last_modified is None:
+        # Never earlier than a time handed out before it was evicted
+        cache.add(key, timezone.now().replace(microsecond=0), None)
+        last_modified = cache.get(key)
+    return last_modified
+
+
+def _bump_versions(pks):
+    pks = list(pks)
+    if pks:
+        _on_commit(lambda: _bump_versions_now(pks))
+
+
+def _bump_versions_now(pks):
+    for pk in pks:
+        key = _get_version_key(pk)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, _new_version(), None)
+    now = timezone.now().replace(microsecond=0)
+    cache.set_many(dict((_get_modified_key(pk), now) for pk in pks), None)
+
+
+def _build_definitions(listings):
+    """Return the definitions of listings by id. One query is needed per
+    relation regardless of the number of listings."""
+    definitions = {}
+    for listing in listings:
+        definitions[listing.pk] = {
+            "content_types": [],
+            "categories": [],
+            "tags": [],
+            "pinned": [],
+            "content": False,
+        }
+    pks = list(definitions.keys())
+
+    for name in ("content_types", "categories", "tags"):
+        field = Listing._meta.get_field(name)
+        related = "%s_id" % field.m2m_reverse_field_name()
+        for pk, related_id in field.remote_field.through.objects.filter(
+            listing_id__in=pks
+        ).order_by(related).values_list("listing_id", related):
+            definitions[pk][name].append(related_id)
+
+    for pk, obj_id in ListingPinned.objects.filter(
+        listing_id__in=pks
+    ).order_by("position", "id").values_list("listing_id", "modelbase_obj_id"):
+        definitions[pk]["pinned"].append(obj_id)
+
+    for pk in ListingContent.objects.filter(listing_id__in=pks).values_list(
+        "listing_id", flat=True
+    ).distinct():
+        definitions[pk]["content"] = True
+
+    return definitions
+
+
+def prime_definitions(listings):
+    """Load the definitions of many listings with a single cache lookup.
+    Definitions missing from the cache are built in bulk."""
+    listings = [
+        listing for listing in listings
+        if getattr(listing, "_definition", None) is None
+    ]
+    if not listings:
+        return
+    keys = dict(
+        (_get_definition_key(listing.pk), listing) for listing in listings
+    )
+    cached = cache.get_many(list(keys.keys()))
+    built = _build_definitions(
+        [listing for key, listing in keys.items() if key not in cached]
+    )
+    if built:
+        cache.set_many(dict(
+            (_get_definition_key(pk), definition)
+            for pk, definition in built.items()
+        ), DEFINITION_TIMEOUT)
+    for key, listing in keys.items():
+        listing._definition = cached[key] if key in cached \
+            else built[listing.pk]
+
+
+def _membership_index_enabled():
+    return getattr(settings, "LISTING", {}).get("membership_index", False)
+
+
+def _get_membership_candidates(obj):
+    """Return listings which may gain or lose the item"""
+    return _get_affected_listings(obj) | Listing.objects.filter(
+        id__in=ListingMembership.objects.filter(
+            modelbase_obj=obj
+        ).values("listing")
+    )
+
+
+def _get_affected_listings(obj):
+    """Return listings whose items may change when obj changes, including
+    the listings of its previous primary category."""
+    q = Listing.objects.affected_by(obj)
+    category_id = getattr(obj, "_listing_primary_category_id", None)
+    if category_id and (category_id != obj.primary_category_id):
+        q = q | Listing.objects.filter(
+            id__in=Listing.categories.through.objects.filter(
+                category=category_id
+            ).values("listing")
+        )
+    return q
+
+
+def _update_membership(objs):
+    for obj in objs:
+        for listing in _get_membership_candidates(obj):
+            listing.update_membership(obj)
+
+
+def _get_through_ids(through, instance, name):
+    """Return the ids on the name side of the many to many rows linked to
+    instance."""
+    attname = through._meta.get_field(name).attname
+    for field in through._meta.concrete_fields:
+        if field.is_relation and (field.name != name):
+            return list(through.objects.filter(
+                **{field.name: instance}
+            ).values_list(attname, flat=True))
+    return []
+
+
+@receiver(pre_save)
+def on_modelbase_pre_save(sender, instance, **kwargs):
+    # A change of primary category affects the listings of the old one too
+    if issubclass(sender, ModelBase) and instance.pk:
+        instance._listing_primary_category_id = ModelBase.objects.filter(
+            pk=instance.pk
+        ).values_list("primary_category_id", flat=True).first()
+
+
+@receiver(post_save)
+def on_modelbase_post_save(sender, **kwargs):
+    if not issubclass(sender, ModelBase):
+        return
     instance = kwargs["instance"]
-    if (kwargs["action"] == "post_add") \
-        and sender.__name__.endswith("_sites") \
-        and isinstance(instance, (Listing,)):
-        for site in instance.sites.all():
-            q = instance.__class__.objects.filter(slug=instance.slug, sites=site).exclude(id=instance.id)
-            if q.exists():
-                raise RuntimeError("The slug %s is already in use for site %s by %s" % (instance.slug, site.domain, q[0].title))
+    _bump_versions(
+        _get_affected_listings(instance).values_list("id", flat=True)
+    )
+    if _membership_index_enabled():
+        _update_membership([instance])
+
+
+@receiver(pre_delete)
+def on_modelbase_pre_delete(sender, instance, **kwargs):
+    # The relations are gone once the item is deleted
+    if issubclass(sender, ModelBase):
+        instance._listing_ids = list(
+            _get_affected_listings(instance).values_list("id", flat=True)
+        )
+
+
+@receiver(post_delete)
+def on_modelbase_post_delete(sender, instance, **kwargs):
+    if issubclass(sender, ModelBase):
+        _bump_versions(getattr(instance, "_listing_ids", []))
+
+
+def _get_category_listing_ids(instance):
+    """Return the ids of the listings that select items by category or tag
+    instance."""
+    return list(
+        instance.listing_tags.values_list("id", flat=True)
+        if isinstance(instance, Tag)
+        else instance.listing_categories.values_list("id", flat=True)
+    )
+
 
+@receiver(m2m_changed, sender=ModelBase.categories.through)
+@receiver(m2m_changed, sender=ModelBase.tags.through)
+def on_modelbase_m2m_changed(sender, instance, action, reverse, pk_set,
+        **kwargs):
+    if not reverse:
+        # Listings may gain and lose the item so consider both states
+        if action in ("pre_add", "pre_remove", "pre_clear"):
+            instance._listing_ids = list(
+                _get_affected_listings(instance).values_list("id", flat=True)
+            )
+        else:
+            _bump_versions(
+                set(getattr(instance, "_listing_ids", []))
+                | set(_get_affected_listings(instance).values_list(
+                    "id", flat=True
+                ))
+            )
+            if _membership_index_enabled():
+                _update_membership([instance])
+        return
+
+    # The instance is a category or tag
+    if action in ("post_add", "post_remove", "post_clear"):
+        _bump_versions(_get_category_listing_ids(instance))
+    if not _membership_index_enabled():
+        return
+
+    # A clear does not provide the items so remember them beforehand
+    if action == "pre_clear":
+        instance._listing_membership_ids = _get_through_ids(
+            sender, instance, "modelbase"
+        )
+    elif action in ("post_add", "post_remove"):
+        _update_membership(ModelBase.objects.filter(id__in=pk_set))
+    elif action == "post_clear":
+        _update_membership(ModelBase.objects.filter(
+            id__in=getattr(instance, "_listing_membership_ids", [])
+        ))
+
+
+@receiver(m2m_changed, sender=ModelBase.sites.through)
+@receiver(m2m_changed, sender=ModelBase.layers.through)
+def on_modelbase_sites_changed(sender, instance, action, reverse, pk_set,
+        **kwargs):
+    # Sites and layers decide which items are permitted
+    if not reverse:
+        if action in ("post_add", "post_remove", "post_clear"):
+            _bump_versions(
+                _get_affected_listings(instance).values_list("id", flat=True)
+            )
+        return
+
+    # The instance is a site or layer. A clear does not provide the items so
+    # remember them beforehand.
+    if action == "pre_clear":
+        instance._listing_item_ids = _get_through_ids(
+            sender, instance, "modelbase"
+        )
+        return
+    if action not in ("post_add", "post_remove", "post_clear"):
+        return
+    if action == "post_clear":
+        pk_set = getattr(instance, "_listing_item_ids", [])
+    ids = set()
+    for obj in ModelBase.objects.filter(id__in=pk_set):
+        ids.update(_get_affected_listings(obj).values_list("id", flat=True))
+    _bump_versions(ids)
+
+
+def _listings_changed(listings, rebuild=True):
+    """Invalidate listings whose definition changed and rebuild their
+    membership index."""
+    _invalidate_listings([listing.pk for listing in listings])
+    for listing in listings:
+        listing._definition = None
+        if rebuild and _membership_index_enabled():
+            listing.build_membership()
+
+
+@receiver(post_save, sender=Listing)
+@receiver(post_delete, sender=Listing)
+def on_listing_saved(sender, instance, **kwargs):
+    instance.invalidate()
+
+
+@receiver(post_save, sender=ListingContent)
+@receiver(post_delete, sender=ListingContent)
+@receiver(post_save, sender=ListingPinned)
+@receiver(post_delete, sender=ListingPinned)
+def on_listing_through_changed(sender, instance, **kwargs):
+    _invalidate_listings([instance.listing_id])
+
+
+@receiver(m2m_changed, sender=Listing.content_types.through)
+@receiver(m2m_changed, sender=Listing.categories.through)
+@receiver(m2m_changed, sender=Listing.tags.through)
+@receiver(m2m_changed, sender=Listing.sites.through)
+def on_listing_m2m_changed(sender, instance, action, reverse, pk_set,
+        **kwargs):
+    # Sites do not affect which items match
+    rebuild = sender is not Listing.sites.through
+    if not reverse:
+        if action in ("post_add", "post_remove", "post_clear"):
+            _listings_changed([instance], rebuild=rebuild)
+        return
+
+    # The instance is eg. a category. A clear does not provide the listings
+    # so remember them beforehand.
+    if action == "pre_clear":
+        instance._listing_ids = _get_through_ids(sender, instance, "listing")
+    elif action in ("post_add", "post_remove", "post_clear"):
+        if action == "post_clear":
+            pk_set = getattr(instance, "_listing_ids", [])
+        _listings_changed(
+            list(Listing.objects.filter(id__in=pk_set)), rebuild=rebuild
+        )
+
+
+@receiver(pre_delete, sender=Category)
+@receiver(pre_delete, sender=Tag)
+def on_category_pre_delete(sender, instance, **kwargs):
+    # The many to many rows are removed without any signals
+    instance._listing_ids = _get_category_listing_ids(instance)
+
+
+@receiver(post_delete, sender=Category)
+@receiver(post_delete, sender=Tag)
+def on_category_post_delete(sender, instance, **kwargs):
+    _listings_changed(list(Listing.objects.filter(
+        id__in=getattr(instance, "_listing_ids", [])
+    )))
+
+
+def _get_slug_conflict(slug, site_ids, exclude=None):
+    """Return the first ListingSiteSlug using slug on one of the sites, not
+    counting listing exclude"""
+    return ListingSiteSlug.objects.filter(
+        slug=slug, site__in=site_ids
+    ).exclude(listing=exclude).select_related("listing", "site").first()
+
+
+def _raise_slug_conflict(slug, site_ids, exclude):
+    conflict = _get_slug_conflict(slug, site_ids, exclude)
+    if conflict is None:
+        raise RuntimeError("The slug %s is already in use" % slug)
+    raise RuntimeError(
+        "The slug %s is already in use for site %s by %s" % (
+            slug, conflict.site.domain, conflict.listing.title
+        )
+    )
+
+
+def _add_site_slugs(rows):
+    """Create ListingSiteSlug rows for (listing, site id) tuples. Raise
+    RuntimeError if a slug is already in use on a site."""
+    if not rows:
+        return
+    try:
+        # A savepoint keeps the surrounding transaction usable
+        with transaction.atomic():
+            ListingSiteSlug.objects.bulk_create([
+                ListingSiteSlug(
+                    listing_id=listing.pk, site_id=site_id, slug=listing.slug
+                ) for listing, site_id in rows
+            ])
+    except IntegrityError:
+        for listing, site_id in rows:
+            if _get_slug_conflict(listing.slug, [site_id], listing.pk):
+                _raise_slug_conflict(listing.slug, [site_id], listing.pk)
+        raise
+
+
+@receiver(m2m_changed, sender=Listing.sites.through)
+def check_slug(sender, instance, action, reverse, pk_set, **kwargs):
+    """Slug must be unique per site. The slugs of the new sites are written
+    before the sites are added so a conflict prevents the add."""
+    if action == "pre_add":
+        if reverse:
+            existing = set(ListingSiteSlug.objects.filter(
+                site=instance, listing__in=pk_set
+            ).values_list("listing_id", flat=True))
+            _add_site_slugs([
+                (listing, instance.pk) for listing in
+                Listing.objects.filter(id__in=pk_set).exclude(id__in=existing)
+            ])
+        else:
+            existing = set(ListingSiteSlug.objects.filter(
+                listing=instance, site__in=pk_set
+            ).values_list("site_id", flat=True))
+            _add_site_slugs([
+                (instance, site_id) for site_id in pk_set
+                if site_id not in existing
+            ])
+    elif action == "post_remove":
+        if reverse:
+            ListingSiteSlug.objects.filter(
+                site=instance, listing__in=pk_set
+            ).delete()
+        else:
+            ListingSiteSlug.objects.filter(
+                listing=instance, site__in=pk_set
+            ).delete()
+    elif action == "post_clear":
+        if reverse:
+            ListingSiteSlug.objects.filter(site=instance).delete()
+        else:
+            ListingSiteSlug.objects.filter(listing=instance).delete()
+
+
+@receiver(post_save, sender=Listing)
+def on_listing_slug_saved(sender, instance, **kwargs):
+    instance._listing_slug = instance.slug
+
+
+@receiver(pre_save, sender=Listing)
+def on_listing_pre_save(sender, instance, **kwargs):
+    # Carry a changed slug over to the sites of the listing
+    if instance.pk is None:
+        return
+    stored = getattr(instance, "_listing_slug", None)
+    if (stored is not None) and (stored == instance.slug):
+        return
+    try:
+        with transaction.atomic():
+            ListingSiteSlug.objects.filter(listing=instance).exclude(
+                slug=instance.slug
+            ).update(slug=instance.slug)
+    except IntegrityError:
+        _raise_slug_conflict(
+            instance.slug,
+            ListingSiteSlug.objects.filter(listing=instance).values("site"),
+            instance.pk
+        )
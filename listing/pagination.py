@@ -0,0 +1,150 @@
+import base64
+import datetime
+import json
+
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.db import connection
+from django.db.models import Q
+from django.utils.http import urlencode
+
+
+def encode_cursor(values, served=0):
+    """Return an opaque string for the ordering values of the last item on a
+    page and the number of items served up to and including that page."""
+    li = []
+    for value in values:
+        if isinstance(value, datetime.datetime):
+            # Retain microseconds. They matter for equality comparisons.
+            value = value.isoformat()
+        li.append(value)
+    raw = json.dumps({"k": li, "n": served}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor):
+    """Inverse of encode_cursor. Raises ValueError if the cursor is
+    malformed."""
+    try:
+        di = json.loads(
+            base64.urlsafe_b64decode(str(cursor)).decode("utf-8")
+        )
+        return list(di["k"]), int(di["n"])
+    except (TypeError, ValueError, KeyError):
+        raise ValueError("Invalid cursor %s" % cursor)
+
+
+def _nulls_first(descending):
+    nulls_largest = connection.features.nulls_order_largest
+    return nulls_largest if descending else not nulls_largest
+
+
+def clean_values(queryset, keys, values):
+    """Convert the values of a decoded cursor to the types of the fields in
+    keys. Raises ValueError if a value does not fit its field."""
+    if len(values) != len(keys):
+        raise ValueError("Expected %s values" % len(keys))
+    li = []
+    for key, value in zip(keys, values):
+        if value is None:
+            li.append(None)
+            continue
+        try:
+            field = queryset.model._meta.get_field(key.lstrip("-"))
+        except FieldDoesNotExist:
+            # Annotations are integer positions in our use
+            field = None
+        try:
+            if field is None:
+                if isinstance(value, bool):
+                    raise TypeError
+                li.append(int(value))
+            else:
+                li.append(field.to_python(value))
+        except (TypeError, ValidationError):
+            raise ValueError("Invalid cursor value %r" % (value,))
+    return li
+
+
+def keyset_filter(queryset, keys, values):
+    """Return a Q object selecting the rows that sort after values. Keys are
+    order_by style field names, eg. ("-publish_on", "-created", "-id")."""
+    key, rest = keys[0], keys[1:]
+    value, rest_values = values[0], values[1:]
+    descending = key.startswith("-")
+    name = key.lstrip("-")
+    op = "lt" if descending else "gt"
+    try:
+        nullable = queryset.model._meta.get_field(name).null
+    except FieldDoesNotExist:
+        # Annotations are not nullable in our use
+        nullable = False
+
+    if value is None:
+        # Only other nulls can tie with a null
+        q = Q(**{"%s__isnull" % name: True})
+        if rest:
+            q = q & keyset_filter(queryset, rest, rest_values)
+        if _nulls_first(descending):
+            q = q | Q(**{"%s__isnull" % name: False})
+        return q
+
+    q = Q(**{"%s__%s" % (name, op): value})
+    if rest:
+        q = q | (Q(**{name: value}) & keyset_filter(queryset, rest, rest_values))
+    if nullable and not _nulls_first(descending):
+        q = q | Q(**{"%s__isnull" % name: True})
+    return q
+
+
+class KeysetPage(object):
+    """A page of results and the cursor for the page following it"""
+
+    def __init__(self, object_list, next_cursor=None, cursor_name="cursor"):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.cursor_name = cursor_name
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def next_querystring(self):
+        if self.next_cursor is None:
+            return ""
+        return urlencode({self.cursor_name: self.next_cursor})
+
+
+def paginate(queryset, keys, cursor=None, limit=10, count=0):
+    """Return a KeysetPage of at most limit items following cursor. The
+    queryset is ordered by keys which must yield a total ordering. If count is
+    set then no more than count items are served across all pages."""
+    served = 0
+    if cursor:
+        values, served = decode_cursor(cursor)
+        values = clean_values(queryset, keys, values)
+        queryset = queryset.filter(keyset_filter(queryset, keys, values))
+
+    if count:
+        limit = max(min(limit, count - served), 0)
+    if not limit:
+        return KeysetPage([])
+
+    # Fetch one extra item to find out if there is a next page
+    li = list(queryset.order_by(*keys)[:limit + 1])
+    next_cursor = None
+    if len(li) > limit:
+        li = li[:limit]
+        served += limit
+        if not count or (served < count):
+            last = li[-1]
+            next_cursor = encode_cursor(
+                [getattr(last, key.lstrip("-")) for key in keys], served
+            )
+    return KeysetPage(li, next_cursor)
@@ -0,0 +1,111 @@
+import json
+import os
+
+from django.conf import settings
+from django.contrib.sites.shortcuts import get_current_site
+from django.db.models import Case, IntegerField, Value, When
+
+from crum import get_current_request
+from jmbo.models import ModelBase
+from layers import get_current_layer
+
+
+def get_snapshot_dir():
+    return getattr(settings, "LISTING", {}).get("snapshot_dir", None)
+
+
+def get_snapshot_path(listing, directory=None):
+    return os.path.join(
+        directory or get_snapshot_dir(), "%s.json" % listing.pk
+    )
+
+
+def get_snapshot_scope(request=None):
+    """Return the site id and layer that the permitted items are filtered by.
+    It defaults to the current request, like the permitted manager."""
+    if request is None:
+        request = get_current_request()
+    return [get_current_site(request).pk, get_current_layer(request)]
+
+
+def build_snapshot(listing, summaries=False):
+    """Return the permitted items of a listing in a form suitable for JSON.
+    The version is read first so a change while building makes the snapshot
+    stale instead of wrong."""
+    data = {
+        "id": listing.pk,
+        "slug": listing.slug,
+        "version": listing.version,
+        "scope": get_snapshot_scope(),
+    }
+    items = list(listing.queryset_permitted)
+    data["items"] = [obj.pk for obj in items]
+    data["pinned"] = list(
+        listing.pinned_queryset_permitted.values_list("id", flat=True)
+    )
+    if summaries:
+        data["summaries"] = [{
+            "id": obj.pk,
+            "title": obj.title,
+            "slug": obj.slug,
+            "publish_on": obj.publish_on.isoformat()
+                if obj.publish_on else None,
+        } for obj in items]
+    return data
+
+
+def read_snapshot(path):
+    try:
+        with open(path) as fp:
+            return json.load(fp)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def write_snapshot(listing, directory=None, summaries=False):
+    """Write the snapshot of a listing unless the one on disk is current.
+    Return whether a file was written."""
+    path = get_snapshot_path(listing, directory)
+    existing = read_snapshot(path)
+    if (existing is not None) \
+        and (existing.get("version") == listing.version) \
+        and (existing.get("scope") == get_snapshot_scope()) \
+        and (("summaries" in existing) == summaries):
+        return False
+
+    data = build_snapshot(listing, summaries=summaries)
+    # Replace the file in one step so readers never see a partial file
+    tmp = "%s.tmp" % path
+    with open(tmp, "w") as fp:
+        json.dump(data, fp, sort_keys=True, separators=(",", ":"))
+    os.rename(tmp, path)
+    return True
+
+
+def load_snapshot(listing, version=None, request=None):
+    """Return the snapshot of a listing if snapshots are configured and the
+    snapshot is current, else None. Pass version if it is already known.
+    Snapshots hold the items permitted for one site and layer, so there is
+    none for a request to another site or layer."""
+    if not get_snapshot_dir():
+        return None
+    data = read_snapshot(get_snapshot_path(listing))
+    if data is None:
+        return None
+    if version is None:
+        version = listing.version
+    if data.get("version") != version:
+        return None
+    if data.get("scope") != get_snapshot_scope(request):
+        return None
+    return data
+
+
+def get_snapshot_queryset(ids):
+    """Return a queryset of the permitted items with ids in that order"""
+    if not ids:
+        return ModelBase.objects.none()
+    return ModelBase.permitted.filter(id__in=ids).order_by(Case(
+        *[When(id=pk, then=Value(n)) for n, pk in enumerate(ids)],
+        output_field=IntegerField()
+    ))
@@ -0,0 +1,116 @@
+/*
+Ordered item selection for the listing admin. The options of the select are
+the chosen items in order. Items are added by searching, and highlighted
+options can be moved or removed. All options are submitted.
+*/
+(function() {
+
+    function button(label, onclick) {
+        var el = document.createElement("button");
+        el.type = "button";
+        el.textContent = label;
+        el.addEventListener("click", onclick);
+        return el;
+    }
+
+    function init(select) {
+        var url = select.getAttribute("data-search-url");
+        var container = document.createElement("div");
+        var input = document.createElement("input");
+        var results = document.createElement("ul");
+        var more = button("More", function() { search(more.cursor); });
+        var timer = null;
+
+        input.type = "text";
+        input.placeholder = "Title starts with";
+        more.style.display = "none";
+        results.style.listStyle = "none";
+        results.style.padding = "0";
+
+        function add(id, text) {
+            for (var i = 0; i < select.options.length; i++) {
+                if (select.options[i].value == id)
+                    return;
+            }
+            select.appendChild(new Option(text, id, false, false));
+        }
+
+        function search(cursor) {
+            var query = "?q=" + encodeURIComponent(input.value);
+            if (cursor)
+                query += "&cursor=" + encodeURIComponent(cursor);
+            var request = new XMLHttpRequest();
+            request.open("GET", url + query);
+            request.onload = function() {
+                if (request.status != 200)
+                    return;
+                var data = JSON.parse(request.responseText);
+                if (!cursor)
+                    results.innerHTML = "";
+                data.results.forEach(function(item) {
+                    var li = document.createElement("li");
+                    var a = document.createElement("a");
+                    a.href = "#";
+                    a.textContent = item.text;
+                    a.addEventListener("click", function(event) {
+                        event.preventDefault();
+                        add(item.id, item.text);
+                    });
+                    li.appendChild(a);
+                    results.appendChild(li);
+                });
+                more.cursor = data.next_cursor;
+                more.style.display = data.next_cursor ? "" : "none";
+            };
+            request.send();
+        }
+
+        function move(step) {
+            var options = Array.prototype.slice.call(select.options);
+            if (step > 0)
+                options.reverse();
+            options.forEach(function(option) {
+                if (!option.selected)
+                    return;
+                var other = step < 0 ? option.previousElementSibling : option.nextElementSibling;
+                if (other && !other.selected)
+                    select.insertBefore(step < 0 ? option : other, step < 0 ? other : option);
+            });
+        }
+
+        input.addEventListener("input", function() {
+            clearTimeout(timer);
+            timer = setTimeout(function() { search(null); }, 300);
+        });
+
+        // Highlighting only marks options to move or remove
+        Array.prototype.forEach.call(select.options, function(option) {
+            option.selected = false;
+        });
+        select.form.addEventListener("submit", function() {
+            Array.prototype.forEach.call(select.options, function(option) {
+                option.selected = true;
+            });
+        });
+
+        container.appendChild(button("Up", function() { move(-1); }));
+        container.appendChild(button("Down", function() { move(1); }));
+        container.appendChild(button("Remove", function() {
+            Array.prototype.slice.call(select.options).forEach(function(option) {
+                if (option.selected)
+                    select.removeChild(option);
+            });
+        }));
+        container.appendChild(input);
+        container.appendChild(results);
+        container.appendChild(more);
+        select.parentNode.insertBefore(container, select.nextSibling);
+    }
+
+    document.addEventListener("DOMContentLoaded", function() {
+        Array.prototype.forEach.call(
+            document.querySelectorAll("select.listing-item-select"), init
+        );
+    });
+
+})();
@@ -1,15 +1,32 @@
 import inspect
+import threading
 from importlib import import_module
 
-from django.template.loader import render_to_string
 from django.conf import settings
+from django.db.models.query import QuerySet
+from django.template import Template, loader
+
+from crum import get_current_request, set_current_request
+from layers import get_current_layer
+
+
+# Compiled templates by name and layer
+_templates = {}
 
 
 class AbstractBaseStyle(object):
     image_path = "/admin/listing/images/unknown.png"
 
+    # Relations the item templates use. They are loaded in bulk for the items
+    # on the page being rendered.
+    select_related = ("primary_category",)
+    prefetch_related = ("categories",)
+
     def __init__(self, listing):
         self.listing = listing
+        # Set by arender once the items are fetched
+        self.object_list = None
+        self.pinned_list = None
 
     def get_queryset(self):
         return self.listing.queryset_permitted
@@ -22,20 +39,111 @@ class AbstractBaseStyle(object):
         return getattr(self.listing, "pinned_queryset_permitted", ModelBase.objects.none())
 
     def get_context_data(self, context, as_tile=False):
-        context["object_list"] = self.get_queryset()
-        context["pinned_list"] = self.get_pinned_queryset()
+        # Hand templates leaf class instances with the related lookups loaded.
+        # This avoids queries per item when rendering each item.
+        context["object_list"] = self.object_list \
+            if self.object_list is not None else self.get_object_list()
+        context["pinned_list"] = self.pinned_list \
+            if self.pinned_list is not None else self.get_pinned_list()
         context["listing"] = self.listing
         context["items_per_page"] = self.listing.items_per_page
         context["identifier"] = getattr(self.listing, "id", None) \
             or getattr(self.listing, "identifier", "")
         return context
 
+    def get_object_list(self, queryset=None):
+        from listing.utils import with_leaf_classes
+        return with_leaf_classes(
+            self.get_queryset() if queryset is None else queryset,
+            self.select_related, self.prefetch_related
+        )
+
+    def get_pinned_list(self, queryset=None):
+        from listing.utils import with_leaf_classes
+        return with_leaf_classes(
+            self.get_pinned_queryset() if queryset is None else queryset,
+            self.select_related, self.prefetch_related
+        )
+
+    def get_template(self):
+        """Return the compiled template. It is cached unless the template
+        engine is in debug mode. Layer aware loaders pick the template by the
+        layer of the current request, so the cache is per layer."""
+        key = (self.template_name, get_current_layer(get_current_request()))
+        template = _templates.get(key, None)
+        if template is None:
+            template = loader.get_template(self.template_name)
+            # Unwrap the template of the Django backend
+            template = getattr(template, "template", template)
+            if not getattr(getattr(template, "engine", None), "debug", True):
+                _templates[key] = template
+        return template
+
     def render(self, context, as_tile=False):
+        template = self.get_template()
         context.push()
-        new_context = self.get_context_data(context, as_tile=as_tile)
-        result = render_to_string(self.template_name, new_context.flatten())
-        context.pop()
-        return result
+        try:
+            new_context = self.get_context_data(context, as_tile=as_tile)
+            if isinstance(template, Template):
+                # Render against the context itself instead of a flattened
+                # copy of all its layers.
+                return template.render(new_context)
+            return template.render(new_context.flatten())
+        finally:
+            context.pop()
+
+    def get_page_slice(self, context):
+        """Return the start and stop of the items on the page the request in
+        context asks for, or None when the listing is not paginated."""
+        per_page = self.listing.items_per_page
+        if not per_page:
+            return None
+        request = context.get("request", None)
+        try:
+            page = max(int(request.GET.get("page", 1)), 1)
+        except (AttributeError, TypeError, ValueError):
+            # The paginator in the template reports the invalid page
+            page = 1
+        start = (page - 1) * per_page
+        # A paginator may fold orphans into the last page
+        return start, start + per_page + getattr(
+            settings, "PAGINATION_DEFAULT_ORPHANS", 0
+        )
+
+    def arender(self, context, as_tile=False):
+        """Return an awaitable for the rendered listing. The items are fetched
+        in an executor and the template is rendered in the event loop thread
+        once they arrive, since the context may not be shared across
+        threads. Only the items on the current page are fetched. The request
+        in context is the current request while fetching, so the items are
+        permitted for its site and layer."""
+        from listing.utils import ItemList, PageList, chain, run_in_executor
+
+        request = context.get("request", None)
+        page_slice = self.get_page_slice(context)
+
+        def fetch():
+            previous = get_current_request()
+            set_current_request(request)
+            try:
+                queryset = self.get_queryset()
+                if page_slice is None or not isinstance(queryset, QuerySet):
+                    object_list = ItemList(self.get_object_list(queryset))
+                else:
+                    start, stop = page_slice
+                    object_list = PageList(
+                        self.get_object_list(queryset[start:stop]),
+                        start, queryset.count()
+                    )
+                return object_list, ItemList(self.get_pinned_list())
+            finally:
+                set_current_request(previous)
+
+        def render(lists):
+            self.object_list, self.pinned_list = lists
+            return self.render(context, as_tile=as_tile)
+
+        return chain(run_in_executor(fetch), render)
 
 
 class Horizontal(AbstractBaseStyle):
@@ -88,23 +196,150 @@ class CustomFive(AbstractBaseStyle):
     image_path = "/admin/listing/images/custom-five.png"
 
 
-LISTING_CLASSES = []
-LISTING_MAP = {}
-for klass in (Horizontal, Vertical, Promo, VerticalThumbnail, Widget):
-    LISTING_CLASSES.append(klass)
-    LISTING_MAP[klass.__name__] = klass
-for app in settings.INSTALLED_APPS:
-    if app == "listing":
-        continue
-    try:
-        mod = import_module(app + ".listing_styles")
-    except ImportError:
-        pass
+class StyleList(list):
+    """List of style classes. Styles are discovered on first use."""
+
+    def __iter__(self):
+        autodiscover()
+        return super(StyleList, self).__iter__()
+
+    def __len__(self):
+        autodiscover()
+        return super(StyleList, self).__len__()
+
+    def __getitem__(self, index):
+        autodiscover()
+        return super(StyleList, self).__getitem__(index)
+
+    def __contains__(self, klass):
+        autodiscover()
+        return super(StyleList, self).__contains__(klass)
+
+    def index(self, *args):
+        autodiscover()
+        return super(StyleList, self).index(*args)
+
+
+class StyleMap(dict):
+    """Style classes by name. Styles are discovered on first use."""
+
+    def __iter__(self):
+        autodiscover()
+        return super(StyleMap, self).__iter__()
+
+    def __len__(self):
+        autodiscover()
+        return super(StyleMap, self).__len__()
+
+    def __getitem__(self, name):
+        autodiscover()
+        return super(StyleMap, self).__getitem__(name)
+
+    def __contains__(self, name):
+        autodiscover()
+        return super(StyleMap, self).__contains__(name)
+
+    def get(self, *args):
+        autodiscover()
+        return super(StyleMap, self).get(*args)
+
+    def keys(self):
+        autodiscover()
+        return super(StyleMap, self).keys()
+
+    def values(self):
+        autodiscover()
+        return super(StyleMap, self).values()
+
+    def items(self):
+        autodiscover()
+        return super(StyleMap, self).items()
+
+
+class StyleChoices(object):
+    """Choices for the style field. They are evaluated when used so defining
+    the model does not discover styles."""
+
+    def __iter__(self):
+        return iter([
+            (klass.__name__, klass.__name__) for klass in LISTING_CLASSES
+        ])
+
+    def __bool__(self):
+        return True
+
+    __nonzero__ = __bool__
+
+
+LISTING_CLASSES = StyleList()
+LISTING_MAP = StyleMap()
+
+_state = {"discovered": False, "discovering": False, "pending": []}
+
+# Held while discovering. Other threads wait for discovery to complete.
+_lock = threading.RLock()
+
+
+def _add(klass):
+    name = klass.__name__
+    if dict.__contains__(LISTING_MAP, name):
+        # Replace a style of the same name in place
+        old = dict.__getitem__(LISTING_MAP, name)
+        for n, kls in enumerate(list.__iter__(LISTING_CLASSES)):
+            if kls is old:
+                list.__setitem__(LISTING_CLASSES, n, klass)
     else:
-        for name, klass in inspect.getmembers(mod, inspect.isclass):
-            if name != "AbstractBaseStyle":
-                LISTING_CLASSES.append(klass)
-                LISTING_MAP[klass.__name__] = klass
-for klass in (CustomOne, CustomTwo, CustomThree, CustomFour, CustomFive):
-    LISTING_CLASSES.append(klass)
-    LISTING_MAP[klass.__name__] = klass
+        list.append(LISTING_CLASSES, klass)
+    dict.__setitem__(LISTING_MAP, name, klass)
+
+
+def register(klass):
+    """Register a style class. Can be used as a class decorator."""
+    with _lock:
+        if _state["discovered"]:
+            _add(klass)
+        else:
+            _state["pending"].append(klass)
+    return klass
+
+
+def autodiscover():
+    """Collect the styles of this app, the listing_styles modules of the
+    installed apps and explicitly registered styles. It only does work the
+    first time it is called."""
+    if _state["discovered"]:
+        return
+    with _lock:
+        # The modules may use the styles while being imported. The thread
+        # that is discovering returns early instead of recursing.
+        if _state["discovered"] or _state["discovering"]:
+            return
+        _state["discovering"] = True
+        try:
+            _discover()
+            _state["discovered"] = True
+        finally:
+            _state["discovering"] = False
+
+
+def _discover():
+    from django.apps import apps
+
+    for klass in (Horizontal, Vertical, Promo, VerticalThumbnail, Widget):
+        _add(klass)
+    for app_config in apps.get_app_configs():
+        if app_config.name == "listing":
+            continue
+        try:
+            mod = import_module(app_config.name + ".listing_styles")
+        except ImportError:
+            pass
+        else:
+            for name, klass in inspect.getmembers(mod, inspect.isclass):
+                if name != "AbstractBaseStyle":
+                    _add(klass)
+    for klass in _state["pending"]:
+        _add(klass)
+    _state["pending"] = []
+    for klass in (CustomOne, CustomTwo, CustomThree, CustomFour, CustomFive):
+        _add(klass)
@@ -1,14 +1,170 @@
+import hashlib
 import sys
 import types
 
 from django import template
+from django.conf import settings
+from django.contrib.sites.shortcuts import get_current_site
+from django.core.cache import cache
+from django.utils.encoding import force_bytes
 
-from listing.models import Listing
+from layers import get_current_layer
+
+from listing.models import Listing, prime_definitions, _get_version
+from listing.snapshots import get_snapshot_queryset, load_snapshot
 from listing.styles import LISTING_MAP
+from listing.utils import PageList
 
 register = template.Library()
 
 
+# Key under which the listings of a template render are kept
+BATCH_KEY = "listing-batch"
+
+
+def _get_slug(obj):
+    if sys.version_info[0] < 3:
+        kls = types.UnicodeType
+    else:
+        kls = str
+    if isinstance(obj, kls):
+        return obj
+    return None
+
+
+def _resolve_listings(context):
+    """Look up the listings of all listing tags in the template being rendered
+    with one query, and load their definitions with one cache lookup."""
+    tpl = getattr(context.render_context, "template", None) \
+        or getattr(context, "template", None)
+    if tpl is None:
+        return {}
+
+    slugs = set()
+    for node in tpl.nodelist.get_nodes_by_type(
+        (ListingNode, ListingQuerysetNode, ListingPageNode)
+    ):
+        try:
+            slug = _get_slug(getattr(node, node.slug_variable).resolve(context))
+        except template.VariableDoesNotExist:
+            # Eg. a loop variable. Looked up when the node renders.
+            continue
+        if slug is not None:
+            slugs.add(slug)
+    if not slugs:
+        return {}
+
+    listings = {}
+    duplicates = set()
+    for listing in Listing.permitted.filter(slug__in=slugs):
+        if listing.slug in listings:
+            duplicates.add(listing.slug)
+        listings[listing.slug] = listing
+    for slug in duplicates:
+        # Leave it to the individual lookup to complain
+        del listings[slug]
+    prime_definitions(listings.values())
+    for slug in slugs:
+        if slug not in duplicates:
+            listings.setdefault(slug, None)
+    return listings
+
+
+def get_listing(context, slug):
+    """Return the permitted listing for slug or None. The first call while a
+    template renders resolves the listings of all its listing tags at once."""
+    listings = context.render_context.get(BATCH_KEY)
+    if listings is None:
+        listings = _resolve_listings(context)
+        context.render_context[BATCH_KEY] = listings
+    if slug not in listings:
+        try:
+            listings[slug] = Listing.permitted.get(slug=slug)
+        except Listing.DoesNotExist:
+            listings[slug] = None
+    return listings[slug]
+
+
+def _get_fragment_cache_timeout():
+    return getattr(settings, "LISTING", {}).get("fragment_cache", 0)
+
+
+def _hash(*args):
+    return hashlib.md5(
+        force_bytes("-".join(["%s" % arg for arg in args]))
+    ).hexdigest()
+
+
+def _get_site_id(context):
+    request = context.get("request")
+    if request is not None:
+        return get_current_site(request).pk
+    return getattr(settings, "SITE_ID", None)
+
+
+def _get_slug_key(context, slug):
+    # Slugs are only unique per site
+    return "listing-slug-%s" % _hash(slug, _get_site_id(context))
+
+
+def _get_fragment_key(context, slug, pk, style, as_tile):
+    """Return the cache key of a rendered listing. The key changes with the
+    version of the listing, so stale fragments are never served. It varies
+    by everything else the output depends on: the site, the layer and the
+    query string, which pagination links carry over."""
+    request = context.get("request")
+    query = sorted(request.GET.lists()) if request is not None else []
+    return "listing-fragment-%s" % _hash(
+        slug, pk, _get_version(pk), style, _get_site_id(context),
+        get_current_layer(request), query, as_tile
+    )
+
+
+def render_listing(obj, context, as_tile=False):
+    """Render a listing or listing proxy with its style. A current snapshot
+    of a listing replaces the search for its items. Only the items on the
+    current page are fetched."""
+    style = LISTING_MAP[obj.style](obj)
+    if isinstance(obj, Listing):
+        snapshot = load_snapshot(obj, request=context.get("request"))
+        if snapshot is not None:
+            ids = snapshot["items"]
+            page_slice = style.get_page_slice(context)
+            if page_slice is None:
+                style.object_list = style.get_object_list(
+                    get_snapshot_queryset(ids)
+                )
+            else:
+                start, stop = page_slice
+                style.object_list = PageList(
+                    style.get_object_list(
+                        get_snapshot_queryset(ids[start:stop])
+                    ),
+                    start, len(ids)
+                )
+            style.pinned_list = style.get_pinned_list(
+                get_snapshot_queryset(snapshot["pinned"])
+            )
+    return style.render(context, as_tile=as_tile)
+
+
+def render_cached_listing(obj, context, as_tile=False):
+    """Render a listing and, if the fragment cache is enabled, cache the
+    result for the listing tag with its slug"""
+    timeout = _get_fragment_cache_timeout()
+    if not timeout:
+        return render_listing(obj, context, as_tile=as_tile)
+    # Compute the key before rendering. Changes during the render bump the
+    # version so the fragment is never served.
+    key = _get_fragment_key(
+        context, obj.slug, obj.pk, obj.style, as_tile=as_tile
+    )
+    result = render_listing(obj, context, as_tile=as_tile)
+    cache.set(_get_slug_key(context, obj.slug), (obj.pk, obj.style), timeout)
+    cache.set(key, result, timeout)
+    return result
+
+
 @register.filter(name="join_titles")
 def join_titles(value, delimiter=", "):
     return delimiter.join([v.title for v in value])
@@ -35,6 +191,7 @@ def listing(parser, token):
 
 
 class ListingNode(template.Node):
+    slug_variable = "slug_or_queryset"
 
     def __init__(self, slug_or_queryset, **kwargs):
         self.slug_or_queryset = template.Variable(slug_or_queryset)
@@ -43,14 +200,28 @@ class ListingNode(template.Node):
     def render(self, context, as_tile=False):
         slug_or_queryset = self.slug_or_queryset.resolve(context)
 
-        if sys.version_info[0] < 3:
-            kls = types.UnicodeType
-        else:
-            kls = str
-        if isinstance(slug_or_queryset, kls):
-            try:
-                obj = Listing.permitted.get(slug=slug_or_queryset)
-            except Listing.DoesNotExist:
+        slug = _get_slug(slug_or_queryset)
+        timeout = _get_fragment_cache_timeout()
+        if (slug is not None) and timeout:
+            # The slug lookup is cached too so a hit needs no queries at all.
+            # Renaming a listing changes its version which forces a miss.
+            cached = cache.get(_get_slug_key(context, slug))
+            if cached is not None:
+                result = cache.get(
+                    _get_fragment_key(context, slug, *cached, as_tile=as_tile)
+                )
+                if result is not None:
+                    return result
+
+            obj = get_listing(context, slug)
+            if obj is None:
+                cache.delete(_get_slug_key(context, slug))
+                return ""
+            return render_cached_listing(obj, context, as_tile=as_tile)
+
+        if slug is not None:
+            obj = get_listing(context, slug)
+            if obj is None:
                 return ""
 
         else:
@@ -71,7 +242,7 @@ class ListingNode(template.Node):
                 di[k] = template.Variable(v).resolve(context)
             obj = ListingProxy(slug_or_queryset, **di)
 
-        return LISTING_MAP[obj.style](obj).render(context, as_tile=as_tile)
+        return render_listing(obj, context, as_tile=as_tile)
 
 
 @register.tag
@@ -87,6 +258,7 @@ def get_listing_queryset(parser, token):
 
 
 class ListingQuerysetNode(template.Node):
+    slug_variable = "slug"
 
     def __init__(self, slug, as_var):
         self.slug = template.Variable(slug)
@@ -95,11 +267,50 @@ class ListingQuerysetNode(template.Node):
     def render(self, context):
         slug = self.slug.resolve(context)
         as_var = self.as_var.resolve(context)
-        try:
-            obj = Listing.permitted.get(slug=slug)
-            context[as_var] = obj.queryset
-        except Listing.DoesNotExist:
-            obj = None
-            context[as_var] = None
+        obj = get_listing(context, slug)
+        context[as_var] = obj.queryset if obj is not None else None
 
         return ""
+
+
+@register.tag
+def get_listing_page(parser, token):
+    """{% get_listing_page [slug_or_listing] as [varname] %}"""
+    try:
+        tag_name, slug_or_listing, dc, as_var = token.split_contents()
+    except ValueError:
+        raise template.TemplateSyntaxError(
+            "get_listing_page tag has syntax {% get_listing_page [slug_or_listing] as [varname] %}"
+        )
+    return ListingPageNode(slug_or_listing, as_var)
+
+
+class ListingPageNode(template.Node):
+    slug_variable = "slug_or_listing"
+
+    def __init__(self, slug_or_listing, as_var):
+        self.slug_or_listing = template.Variable(slug_or_listing)
+        self.as_var = template.Variable(as_var)
+
+    def render(self, context):
+        obj = self.slug_or_listing.resolve(context)
+        as_var = self.as_var.resolve(context)
+
+        slug = _get_slug(obj)
+        if slug is not None:
+            obj = get_listing(context, slug)
+            if obj is None:
+                context[as_var] = None
+                return ""
+
+        request = context.get("request")
+        cursor = request.GET.get("cursor") if request else None
+        context[as_var] = self.get_page(obj, cursor)
+        return ""
+
+    def get_page(self, obj, cursor):
+        try:
+            return obj.get_page(cursor=cursor)
+        except ValueError:
+            # A stale or tampered cursor. Start at the beginning.
+            return self.get_page(obj, None)
@@ -1,6 +1,14 @@
 from django.contrib.auth import get_user_model
+from django.contrib.contenttypes.models import ContentType
 from django.test import TestCase
 from django.test.client import Client
+
+from jmbo.models import ModelBase
+
+from listing.admin import ListingAdminForm, _vocabularies
+from listing.models import Listing
+from listing.tests.models import ModelA
+from listing.widgets import OrderedModelMultipleChoiceField
 try:
     from django.urls import reverse
 except ImportError:
@@ -34,3 +42,77 @@ class AdminTestCase(TestCase):
             response,
             """<img src="/static/admin/listing/images/horizontal.png" style="max-width: 128px;" />"""
         )
+
+    def test_item_select(self):
+        items = [
+            ModelA.objects.create(title="Item %s" % n, slug="item-%s" % n)
+            for n in range(3)
+        ]
+        listing = Listing.objects.create(title="Items", slug="items")
+        listing.set_content([items[2], items[0]])
+        response = self.client.get(
+            "/admin/listing/listing/%s/change/" % listing.pk
+        )
+        self.assertEqual(response.status_code, 200)
+        content = response.content.decode("utf-8")
+        # Only the selected items are rendered, in order
+        self.failUnless(
+            content.index(">Item 2<") < content.index(">Item 0<")
+        )
+        self.failIf(">Item 1<" in content)
+        self.failUnless("/admin/listing/listing/search/" in content)
+
+    def test_vocabularies(self):
+        ListingAdminForm()
+        # Both vocabularies are cached
+        with self.assertNumQueries(0):
+            form = ListingAdminForm()
+        ids = [ct.id for ct in form.fields["content_types"].queryset]
+        self.failUnless(ContentType.objects.get_for_model(ModelA).id in ids)
+        self.failIf(ContentType.objects.get_for_model(Listing).id in ids)
+
+        # Changing content types discards the cached ids
+        ContentType.objects.create(app_label="listing", model="gone")
+        self.failIf("content_types" in _vocabularies)
+
+    def test_ordered_field(self):
+        items = [
+            ModelA.objects.create(title="Item %s" % n, slug="item-%s" % n)
+            for n in range(3)
+        ]
+        field = OrderedModelMultipleChoiceField(
+            queryset=ModelBase.objects.all(), required=False
+        )
+        self.assertEqual(
+            [o.pk for o in field.clean([items[2].pk, items[0].pk])],
+            [items[2].pk, items[0].pk]
+        )
+        self.assertEqual(field.clean([]), [])
+
+    def test_search(self):
+        for n in range(3):
+            ModelA.objects.create(title="Search %s" % n, slug="search-%s" % n)
+        ModelA.objects.create(title="Other", slug="other")
+        url = "/admin/listing/listing/search/"
+        response = self.client.get(url, {"q": "Search"})
+        as_json = response.json()
+        self.assertEqual(
+            [di["text"] for di in as_json["results"]],
+            ["Search 0", "Search 1", "Search 2"]
+        )
+        self.assertEqual(as_json["next_cursor"], None)
+
+        response = self.client.get(url, {"q": "Search", "cursor": "junk"})
+        self.assertEqual(response.status_code, 400)
+
+        # Staff that may not change listings can not search the items
+        staff = get_user_model().objects.create(
+            username="staff", email="staff@test.com", is_staff=True
+        )
+        staff.set_password("password")
+        staff.save()
+        client = Client()
+        client.login(username="staff", password="password")
+        response = client.get(url, {"q": "Search"})
+        self.assertEqual(response.status_code, 403)
+
@@ -1,15 +1,21 @@
 import os
 import json
+import shutil
+import tempfile
 
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management import call_command
 from django.contrib.sites.models import Site
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from django.utils.six import StringIO
 
 from rest_framework.test import APIClient
 from category.models import Category, Tag
 from jmbo.models import ModelBase
 
 from listing.models import Listing
+from listing.pagination import encode_cursor
 from listing.tests.models import ModelA, ModelB
 
 
@@ -73,6 +79,8 @@ class APITestCase(TestCase):
     def setUp(self):
         super(APITestCase, self).setUp()
         self.client.logout()
+        # Listing ids may be reused across tests
+        cache.clear()
 
     def login(self):
         self.client.login(username="editor-api", password="password")
@@ -122,6 +130,48 @@ class APITestCase(TestCase):
         self.failUnless(self.model_b.modelbase_obj in listing.queryset)
         self.failIf(self.model_a.modelbase_obj in listing.queryset)
 
+    def test_listing_patch_partial(self):
+        self.login()
+        listing = Listing.objects.create(title="patch", slug="patch")
+        listing.set_pinned([self.model_b])
+        response = self.client.patch(
+            "/api/v1/listing-listing/%s/" % listing.pk,
+            json.dumps({"title": "patched"}),
+            content_type="application/json"
+        )
+        self.assertEqual(response.status_code, 200)
+        listing = Listing.objects.get(slug="patch")
+        self.assertEqual(listing.title, "patched")
+        # Items that are not passed are left alone
+        self.assertEqual(
+            [o.id for o in listing.pinned_queryset], [self.model_b.pk]
+        )
+
+    def test_listing_move(self):
+        self.login()
+        url = "/api/v1/listing-listing/%s/move/" % self.listing.pk
+        response = self.client.post(url, json.dumps({
+            "modelbase_obj": "http://testserver/api/v1/jmbo-modelbase/%s/" % \
+                self.model_b.pk,
+            "position": 1
+        }), content_type="application/json")
+        self.assertEqual(response.json()["added"], [self.model_b.pk])
+        listing = Listing.objects.get(slug="listing")
+        self.assertEqual(
+            [o.id for o in listing.content_queryset],
+            [self.model_a.pk, self.model_b.pk, self.model_a_published.pk]
+        )
+
+        response = self.client.post(url, json.dumps({
+            "modelbase_obj": "http://testserver/api/v1/jmbo-modelbase/%s/" % \
+                self.model_a.pk,
+            "position": 0,
+            "pinned": True
+        }), content_type="application/json")
+        self.assertEqual(
+            [o.id for o in listing.pinned_queryset], [self.model_a.pk]
+        )
+
     def test_listing_content(self):
         response = self.client.get(
             "/api/v1/listing-listing/%s/" % self.listing.pk
@@ -143,9 +193,180 @@ class APITestCase(TestCase):
         as_json = response.json()
         self.failUnless(
             "http://testserver/api/v1/jmbo-modelbase/%s/" % \
-                self.model_a.pk in as_json
+                self.model_a.pk in as_json["results"]
         )
         self.failUnless(
             "http://testserver/api/v1/jmbo-modelbase/%s/" % \
-                self.model_a_published.pk in as_json
+                self.model_a_published.pk in as_json["results"]
         )
+        self.assertEqual(as_json["next"], None)
+
+    def test_listing_queryset_pages(self):
+        url = "/api/v1/listing-listing/%s/queryset_objects/" % self.listing.pk
+        for limit in ("-5", "0", "x"):
+            response = self.client.get(url, {"limit": limit})
+            self.assertEqual(response.status_code, 400)
+        response = self.client.get(url, {"limit": 1})
+        as_json = response.json()
+        self.assertEqual(
+            as_json["results"],
+            ["http://testserver/api/v1/jmbo-modelbase/%s/" % self.model_a.pk]
+        )
+        response = self.client.get(as_json["next"])
+        as_json = response.json()
+        self.assertEqual(
+            as_json["results"],
+            ["http://testserver/api/v1/jmbo-modelbase/%s/" % \
+                self.model_a_published.pk]
+        )
+        self.assertEqual(as_json["next"], None)
+
+        response = self.client.get(url, {"cursor": "junk"})
+        self.assertEqual(response.status_code, 404)
+        response = self.client.get(
+            url, {"cursor": encode_cursor([{"a": 1}, 1], 1)}
+        )
+        self.assertEqual(response.status_code, 404)
+
+    def test_listing_queryset_fields(self):
+        url = "/api/v1/listing-listing/%s/queryset_permitted/" % \
+            self.listing.pk
+        response = self.client.get(url, {"fields": "id,title"})
+        self.assertEqual(response.json()["results"], [{
+            "url": "http://testserver/api/v1/jmbo-modelbase/%s/" % \
+                self.model_a_published.pk,
+            "id": self.model_a_published.pk,
+            "title": "ModelA Published"
+        }])
+        response = self.client.get(url, {"fields": "id,password"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_listing_queryset_stream(self):
+        response = self.client.get(
+            "/api/v1/listing-listing/%s/queryset_objects/" % self.listing.pk,
+            {"stream": 1, "fields": "slug"}
+        )
+        self.failUnless(response.streaming)
+        as_json = json.loads(
+            b"".join(response.streaming_content).decode("utf-8")
+        )
+        self.assertEqual(
+            [di["slug"] for di in as_json], ["model-a", "model-a-p"]
+        )
+
+    def test_listing_conditional_get(self):
+        url = "/api/v1/listing-listing/%s/queryset_permitted/" % \
+            self.listing.pk
+        response = self.client.get(url)
+        etag = response["ETag"]
+        last_modified = response["Last-Modified"]
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get(
+            url, HTTP_IF_MODIFIED_SINCE=last_modified
+        )
+        self.assertEqual(response.status_code, 304)
+
+        # Other parameters are another resource
+        response = self.client.get(
+            url, {"limit": 1}, HTTP_IF_NONE_MATCH=etag
+        )
+        self.assertEqual(response.status_code, 200)
+
+        # Another layer permits other items
+        response = self.client.get(
+            url, HTTP_IF_NONE_MATCH=etag, **{"X-Django-Layer": "web"}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+        # Editing an item
+        obj = ModelA.objects.get(pk=self.model_a_published.pk)
+        obj.title = "ModelA Edited"
+        obj.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_listing_snapshot_cursors(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        listing = Listing.objects.create(title="snapshot", slug="snapshot")
+        listing.categories.set([self.cat_a, self.cat_b])
+        ids = [obj.pk for obj in listing.queryset_permitted]
+        self.assertEqual(len(ids), 2)
+        url = "/api/v1/listing-listing/%s/queryset_permitted/" % listing.pk
+
+        def get_ids(as_json):
+            return [
+                int(item.rstrip("/").split("/")[-1])
+                for item in as_json["results"]
+            ]
+
+        # A live page followed by a snapshot page
+        as_json = self.client.get(url, {"limit": 1}).json()
+        self.assertEqual(get_ids(as_json), ids[:1])
+        call_command(
+            "export_listing_snapshots", directory=directory, stdout=StringIO()
+        )
+        with override_settings(LISTING={"snapshot_dir": directory}):
+            as_json = self.client.get(as_json["next"]).json()
+            self.assertEqual(get_ids(as_json), ids[1:])
+            self.assertEqual(
+                self.client.get(url, {"limit": -5}).status_code, 400
+            )
+
+            # A snapshot page followed by a live page once it is stale
+            as_json = self.client.get(url, {"limit": 1}).json()
+            self.assertEqual(get_ids(as_json), ids[:1])
+            listing.title = "snapshot changed"
+            listing.save()
+            response = self.client.get(as_json["next"])
+            self.assertEqual(response.status_code, 200)
+            # The live items start over
+            self.assertEqual(get_ids(response.json()), ids[:1])
+
+    def test_listing_bulk(self):
+        site = Site.objects.get_current()
+        self.listing.sites.set([site])
+        other = Listing.objects.create(title="other", slug="other")
+        other.sites.set([site])
+        other.set_content([self.model_b_published, self.model_a_published])
+        # The same slug on another site is not looked up
+        other_site = Site.objects.create(domain="other.com", name="other.com")
+        Listing.objects.create(title="other", slug="other").sites.set(
+            [other_site]
+        )
+        cache.clear()
+        # The listings, one query per relation for the definitions and two
+        # queries per listing for its first page.
+        with self.assertNumQueries(10):
+            response = self.client.get(
+                "/api/v1/listing-listing-permitted/bulk/",
+                {"slugs": "other", "ids": self.listing.pk, "fields": "title"}
+            )
+        as_json = response.json()["results"]
+        self.assertEqual([di["slug"] for di in as_json], ["listing", "other"])
+        self.assertEqual(
+            [di["title"] for di in as_json[0]["results"]],
+            ["ModelA Published"]
+        )
+        self.assertEqual(
+            [di["title"] for di in as_json[1]["results"]],
+            ["ModelB Published", "ModelA Published"]
+        )
+        self.assertEqual(as_json[1]["next_cursor"], None)
+
+        response = self.client.get(
+            "/api/v1/listing-listing/bulk/", {"slugs": "listing", "limit": 1}
+        )
+        as_json = response.json()["results"]
+        self.assertEqual(
+            as_json[0]["results"],
+            ["http://testserver/api/v1/jmbo-modelbase/%s/" % self.model_a.pk]
+        )
+        self.failUnless(as_json[0]["next_cursor"])
+
+        response = self.client.get("/api/v1/listing-listing/bulk/")
+        self.assertEqual(response.status_code, 400)
+
@@ -0,0 +1,125 @@
+import unittest
+
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
+from django import template
+from django.contrib.sites.models import Site
+from django.core.cache import cache
+from django.test import TransactionTestCase
+from django.test.client import RequestFactory
+
+from category.models import Category
+from crum import set_current_request
+from layers.models import Layer
+
+from listing.management.commands.warm_listings import \
+    get_request_middleware
+from listing.models import Listing
+from listing.styles import LISTING_MAP
+from listing.tests.models import ModelA
+
+
+@unittest.skipUnless(asyncio, "The async API requires Python 3")
+class AsyncTestCase(TransactionTestCase):
+    # The queries run in other threads so the data has to be committed
+
+    def setUp(self):
+        super(AsyncTestCase, self).setUp()
+        cache.clear()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        self.cat_a = Category.objects.create(title="CatA", slug="cat-a")
+        self.items = []
+        for n in range(3):
+            obj = ModelA.objects.create(
+                title="ModelA %s" % n, slug="model-a-%s" % n
+            )
+            obj.publish()
+            obj.categories.set([self.cat_a])
+            obj.sites.set(Site.objects.all())
+            self.items.append(obj)
+        self.listing = Listing.objects.create(slug="async", style="Vertical")
+        self.listing.categories.set([self.cat_a])
+        self.listing.set_pinned([self.items[0]])
+
+    def tearDown(self):
+        asyncio.set_event_loop(None)
+        self.loop.close()
+        super(AsyncTestCase, self).tearDown()
+
+    def test_gather(self):
+        other = Listing.objects.create(slug="async-other")
+        other.set_content([self.items[2], self.items[1]])
+        items, pinned, count, content = self.loop.run_until_complete(
+            asyncio.gather(
+                self.listing.aqueryset(), self.listing.apinned(),
+                self.listing.acount(), other.acontent()
+            )
+        )
+        self.assertEqual(
+            [o.id for o in items], [o.id for o in self.listing.queryset_permitted]
+        )
+        self.assertEqual([o.id for o in pinned], [self.items[0].id])
+        self.assertEqual(count, 2)
+        self.assertEqual(
+            [o.id for o in content], [self.items[2].id, self.items[1].id]
+        )
+
+    def test_iteration(self):
+        iterator = self.listing.__aiter__()
+        li = []
+        while True:
+            try:
+                li.append(self.loop.run_until_complete(iterator.__anext__()))
+            except StopAsyncIteration:
+                break
+        self.assertEqual([o.id for o in li], [o.id for o in self.listing])
+
+    def test_arender(self):
+        context = template.Context({"request": RequestFactory().get("/")})
+        result = self.loop.run_until_complete(
+            LISTING_MAP["Vertical"](self.listing).arender(context)
+        )
+        self.assertEqual(
+            result, LISTING_MAP["Vertical"](self.listing).render(context)
+        )
+        self.failUnless("ModelA 1" in result)
+
+    def test_arender_page(self):
+        self.listing.items_per_page = 1
+        self.listing.save()
+        style = LISTING_MAP["Vertical"](self.listing)
+        results = []
+        for page in (1, 2):
+            request = RequestFactory().get("/", {"page": page})
+            for mw in get_request_middleware():
+                mw.process_request(request)
+            context = template.Context({"request": request})
+            result = self.loop.run_until_complete(style.arender(context))
+            self.assertEqual(
+                result, LISTING_MAP["Vertical"](self.listing).render(context)
+            )
+            # Only the item on the page is fetched. The pinned item is not
+            # part of the items.
+            self.assertEqual(len(style.object_list), 1)
+            self.assertEqual(style.object_list.count(), 2)
+            results.append(result)
+        self.failUnless("ModelA 2" in results[0])
+        self.failUnless("ModelA 1" in results[1])
+
+    def test_current_request(self):
+        layer = Layer.objects.create(name="web")
+        self.items[1].layers.set([layer])
+        request = RequestFactory().get("/", **{"X-Django-Layer": "web"})
+        set_current_request(request)
+        self.addCleanup(set_current_request, None)
+        # The executor applies the layer of the current request
+        items = self.loop.run_until_complete(self.listing.aqueryset())
+        self.assertEqual([o.id for o in items], [self.items[1].id])
+        self.assertEqual(
+            [o.id for o in items], [o.id for o in self.listing.queryset_permitted]
+        )
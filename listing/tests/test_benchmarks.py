@@ -0,0 +1,174 @@
+import os
+import time
+import unittest
+
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
+from django import template
+from django.contrib.contenttypes.models import ContentType
+from django.contrib.sites.models import Site
+from django.core.cache import cache
+from django.db import connection
+from django.template.loader import render_to_string
+from django.test import TestCase, TransactionTestCase
+from django.test.client import RequestFactory
+from django.test.utils import CaptureQueriesContext
+
+from category.models import Category
+
+from listing.models import Listing
+from listing.styles import LISTING_MAP
+from listing.tests.models import ModelA, ModelB
+
+
+# Benchmarks are slow and only informative. Run them with eg.
+# LISTING_BENCHMARK=1 python listing/tests/manage.py test listing.tests.test_benchmarks
+ENABLED = bool(os.environ.get("LISTING_BENCHMARK"))
+ITEMS = int(os.environ.get("LISTING_BENCHMARK_ITEMS", 500))
+REPEAT = int(os.environ.get("LISTING_BENCHMARK_REPEAT", 20))
+
+
+def measure(func):
+    """Return the number of queries of a single call and the mean duration
+    in milliseconds."""
+    with CaptureQueriesContext(connection) as context:
+        func()
+    start = time.time()
+    for n in range(REPEAT):
+        func()
+    return len(context), (time.time() - start) * 1000.0 / REPEAT
+
+
+def report(name, queries, duration):
+    print("\n%s %s: %d queries, %.2fms" % (
+        connection.vendor, name, queries, duration
+    ))
+
+
+@unittest.skipUnless(ENABLED, "Set LISTING_BENCHMARK to run benchmarks")
+class BenchmarksTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super(BenchmarksTestCase, cls).setUpTestData()
+        cls.cat_a = Category.objects.create(title="CatA", slug="cat-a")
+        cls.cat_b = Category.objects.create(title="CatB", slug="cat-b")
+        sites = Site.objects.all()
+        for n in range(ITEMS):
+            klass = ModelA if n % 2 else ModelB
+            obj = klass.objects.create(title="Item %s" % n, slug="item-%s" % n)
+            obj.publish()
+            # Multiple categories cause duplicates in the search
+            obj.categories.set([cls.cat_a, cls.cat_b])
+            obj.sites.set(sites)
+
+        cls.listing = Listing.objects.create(title="Bench", slug="bench")
+        cls.listing.content_types.set([
+            ContentType.objects.get_for_model(ModelA),
+            ContentType.objects.get_for_model(ModelB)
+        ])
+        cls.listing.categories.set([cls.cat_a, cls.cat_b])
+
+    def setUp(self):
+        super(BenchmarksTestCase, self).setUp()
+        cache.clear()
+
+    def test_deduplication(self):
+        listing = self.listing
+        rules = listing._get_rule_queryset(manager="permitted")
+
+        def distinct():
+            # The previous vendor specific strategy
+            if connection.vendor in ("oracle", "sqlite"):
+                q = rules.only("id").distinct()
+            else:
+                q = rules.distinct("publish_on", "created", "id").order_by(
+                    "-publish_on", "-created"
+                )
+            for obj in q[:20]:
+                obj.title, obj.modified
+
+        def semi_join():
+            for obj in listing.queryset_permitted[:20]:
+                obj.title, obj.modified
+
+        report("distinct", *measure(distinct))
+        report("semi-join", *measure(semi_join))
+
+    def test_style_render(self):
+        listing = Listing.objects.create(slug="bench-render", style="Vertical")
+        listing.set_content(self.listing.queryset_permitted[:5])
+        style = LISTING_MAP["Vertical"](listing)
+
+        # A page with a large context
+        context = template.Context({"request": RequestFactory().get("/")})
+        for n in range(50):
+            context.push(dict(("key-%s-%s" % (n, m), m) for m in range(20)))
+
+        def flatten():
+            # The previous strategy
+            context.push()
+            new_context = style.get_context_data(context)
+            render_to_string(style.template_name, new_context.flatten())
+            context.pop()
+
+        def direct():
+            style.render(context)
+
+        # Warm the template and content type caches
+        direct()
+        report("flatten", *measure(flatten))
+        report("direct", *measure(direct))
+
+
+@unittest.skipUnless(
+    ENABLED and asyncio, "Set LISTING_BENCHMARK on Python 3 to run benchmarks"
+)
+class AsyncBenchmarksTestCase(TransactionTestCase):
+    # The queries run in other threads so the data has to be committed
+
+    def setUp(self):
+        super(AsyncBenchmarksTestCase, self).setUp()
+        cache.clear()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.addCleanup(self.loop.close)
+        self.addCleanup(asyncio.set_event_loop, None)
+        sites = Site.objects.all()
+        self.listings = []
+        for n in range(4):
+            category = Category.objects.create(
+                title="Cat %s" % n, slug="cat-%s" % n
+            )
+            for m in range(ITEMS // 4):
+                obj = ModelA.objects.create(
+                    title="Item %s %s" % (n, m), slug="item-%s-%s" % (n, m)
+                )
+                obj.publish()
+                obj.categories.set([category])
+                obj.sites.set(sites)
+            listing = Listing.objects.create(slug="bench-%s" % n)
+            listing.categories.set([category])
+            self.listings.append(listing)
+
+    def test_gather(self):
+
+        def sequential():
+            for listing in self.listings:
+                list(listing.queryset_permitted)
+
+        def gather():
+            self.loop.run_until_complete(asyncio.gather(
+                *[listing.aqueryset() for listing in self.listings]
+            ))
+
+        # Start the executor threads and warm the definition caches
+        gather()
+        queries, duration = measure(sequential)
+        report("sequential", queries, duration)
+        # The queries of gather run in other threads and are not captured.
+        # They are the same queries.
+        report("gather", queries, measure(gather)[1])
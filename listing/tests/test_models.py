@@ -1,20 +1,39 @@
+import json
 import os
+import shutil
+import tempfile
+import threading
+from importlib import import_module
 
+from django import template
+from django.apps import apps
 from django.contrib.auth import get_user_model
+from django.core.management import CommandError, call_command
+from django.core.cache import cache
+from django.db import connection, transaction
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.sites.models import Site
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase, override_settings
 from django.test.client import Client, RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.utils.six import StringIO
 try:
     from django.urls import reverse
 except ImportError:
     from django.core.urlresolvers import reverse
 
 from category.models import Category, Tag
-
-from listing.models import Listing
-from listing.styles import LISTING_CLASSES
+from jmbo.models import ModelBase
+
+from listing.models import Listing, ListingMembership, ListingSiteSlug, \
+    _build_definitions, _get_definition_key
+from listing.pagination import encode_cursor
+from listing.snapshots import load_snapshot
+from listing import styles
+from listing.styles import AbstractBaseStyle, LISTING_CLASSES, LISTING_MAP, \
+    register
 from listing.tests.models import ModelA, ModelB
+from listing.utils import with_leaf_classes
 
 
 RES_DIR = os.path.join(os.path.dirname(__file__), "res")
@@ -83,6 +102,11 @@ class ModelsTestCase(TestCase):
         obj.sites.set(Site.objects.all())
         cls.model_b_published = obj
 
+    def setUp(self):
+        super(ModelsTestCase, self).setUp()
+        # Listing ids may be reused across tests
+        cache.clear()
+
     def test_content_types(self):
         listing = Listing.objects.create()
         listing.save()
@@ -119,6 +143,58 @@ class ModelsTestCase(TestCase):
         self.assertEqual(len(qs), 1)
         self.failUnless(self.model_a_published.modelbase_obj in qs)
 
+    def test_content_order(self):
+        listing = Listing.objects.create()
+        listing.set_content([self.model_a_published, self.model_a])
+        qs = listing.content_queryset
+        self.assertEqual(
+            [o.id for o in qs],
+            [self.model_a_published.id, self.model_a.id]
+        )
+        self.assertEqual(qs.count(), 2)
+        self.assertEqual(qs[1:2][0].id, self.model_a.id)
+
+    def test_set_content_diff(self):
+        listing = Listing.objects.create()
+        listing.set_content([self.model_a_published, self.model_a])
+        self.failUnless(listing.definition["content"])
+        with self.assertNumQueries(7):
+            # Savepoint, read, collect and delete, update, insert, release
+            changes = listing.set_content(
+                [self.model_a.pk, self.model_b, self.model_b]
+            )
+        self.assertEqual(changes, {
+            "added": [self.model_b.pk],
+            "removed": [self.model_a_published.pk],
+            "moved": [self.model_a.pk]
+        })
+        self.assertEqual(
+            [o.id for o in listing.content_queryset],
+            [self.model_a.id, self.model_b.id]
+        )
+        version = listing.version
+        changes = listing.set_content([self.model_a, self.model_b])
+        self.assertEqual(changes, {"added": [], "removed": [], "moved": []})
+        # Nothing changed so the caches derived from the version are kept
+        self.assertEqual(listing.version, version)
+        listing.set_content([])
+        self.failIf(listing.definition["content"])
+
+    def test_move_content(self):
+        listing = Listing.objects.create()
+        listing.set_content([self.model_a, self.model_a_published])
+        changes = listing.move_content(self.model_b, 1)
+        self.assertEqual(changes["added"], [self.model_b.pk])
+        self.assertEqual(
+            [o.id for o in listing.content_queryset],
+            [self.model_a.id, self.model_b.id, self.model_a_published.id]
+        )
+        listing.move_content(self.model_a.pk, 2)
+        self.assertEqual(
+            [o.id for o in listing.content_queryset],
+            [self.model_b.id, self.model_a_published.id, self.model_a.id]
+        )
+
     def test_pinned(self):
         listing = Listing.objects.create()
         listing.set_pinned([self.model_a, self.model_a_published])
@@ -133,6 +209,15 @@ class ModelsTestCase(TestCase):
         self.assertEqual(len(qs), 1)
         self.failUnless(self.model_a_published.modelbase_obj in qs)
 
+    def test_pinned_order(self):
+        listing = Listing.objects.create()
+        listing.set_pinned([self.model_a_published, self.model_a])
+        qs = listing.pinned_queryset
+        self.assertEqual(
+            [o.id for o in qs],
+            [self.model_a_published.id, self.model_a.id]
+        )
+
     def test_content_with_pinned(self):
         """Pinned content is excluded from queryset"""
         listing = Listing.objects.create()
@@ -201,6 +286,330 @@ class ModelsTestCase(TestCase):
         self.assertEqual(len(listing), 1)
         self.failUnless(self.model_a_published.modelbase_obj in listing)
 
+    def test_version(self):
+        listing = Listing.objects.create()
+        listing.categories.set([self.cat_b])
+        version = listing.version
+        self.assertEqual(listing.version, version)
+
+        def failUnlessBumped(func):
+            old = listing.version
+            func()
+            self.assertNotEqual(listing.version, old)
+
+        # Items matching the listing
+        failUnlessBumped(lambda: self.model_b.save())
+        failUnlessBumped(lambda: self.model_a.categories.add(self.cat_b))
+        failUnlessBumped(lambda: self.model_a.categories.remove(self.cat_b))
+        failUnlessBumped(lambda: self.cat_b.modelbase_set.add(self.model_a))
+        failUnlessBumped(lambda: self.model_a.categories.clear())
+        obj = ModelB.objects.create(title="ModelB Temp", slug="model-b-t")
+        obj.categories.set([self.cat_b])
+        failUnlessBumped(lambda: obj.delete())
+
+        # Sites decide whether items are permitted
+        site = Site.objects.all()[0]
+        failUnlessBumped(lambda: self.model_b.sites.set([site]))
+        failUnlessBumped(lambda: site.modelbase_set.remove(self.model_b))
+        failUnlessBumped(lambda: self.model_b.sites.add(site))
+        failUnlessBumped(lambda: site.modelbase_set.clear())
+
+        # The listing itself and its curated and pinned items
+        failUnlessBumped(lambda: listing.set_pinned([self.model_a]))
+        failUnlessBumped(lambda: listing.set_content([self.model_a]))
+        failUnlessBumped(lambda: listing.save())
+        failUnlessBumped(lambda: listing.tags.add(self.tag_a))
+
+        # Unrelated items
+        version = listing.version
+        obj = ModelB.objects.create(title="ModelB Other", slug="model-b-o")
+        obj.categories.set([Category.objects.create(title="CatD", slug="cat-d")])
+        obj.save()
+        self.assertEqual(listing.version, version)
+
+    def test_affected_by(self):
+        ct = ContentType.objects.get_for_model(ModelA)
+        by_content_type = Listing.objects.create(slug="ct")
+        by_content_type.content_types.set([ct])
+        by_category = Listing.objects.create(slug="category")
+        by_category.categories.set([self.cat_a])
+        by_tag = Listing.objects.create(slug="tag")
+        by_tag.tags.set([self.tag_a])
+        by_content = Listing.objects.create(slug="content")
+        by_content.set_content([self.model_a])
+        by_pinned = Listing.objects.create(slug="pinned")
+        by_pinned.set_pinned([self.model_a])
+        unrelated = Listing.objects.create(slug="unrelated")
+        unrelated.categories.set([self.cat_b])
+        unrelated.set_pinned([self.model_b])
+
+        with self.assertNumQueries(1):
+            ids = set(Listing.objects.affected_by(
+                self.model_a
+            ).values_list("id", flat=True))
+        self.assertEqual(ids, set([
+            by_content_type.id, by_category.id, by_tag.id, by_content.id,
+            by_pinned.id
+        ]))
+
+        obj = ModelB.objects.get(id=self.model_b.id)
+        obj.primary_category = self.cat_a
+        self.failUnless(
+            Listing.objects.affected_by(obj).filter(
+                id=by_category.id
+            ).exists()
+        )
+
+    @override_settings(LISTING={"fragment_cache": 60})
+    def test_warm_listings(self):
+        listing = Listing.objects.create(slug="warm", style="Vertical")
+        listing.categories.set([self.cat_a])
+        listing.sites.set(Site.objects.all())
+        Listing.objects.create(slug="warm-other", style="Horizontal")
+        out = StringIO()
+        call_command(
+            "warm_listings", slugs=["warm"], pages=2, stdout=out
+        )
+        lines = out.getvalue().splitlines()
+        self.failUnless(lines[0].startswith("warm: "))
+        self.failUnless(lines[-1].startswith("Warmed 1 listings"))
+
+        # The rendered listing is now cached
+        t = template.Template("{% load listing_tags %}{% listing 'warm' %}")
+        request = RequestFactory().get("/", {"page": 1})
+        with self.assertNumQueries(0):
+            t.render(template.Context({"request": request}))
+
+    @override_settings(LISTING={"fragment_cache": 60})
+    def test_warm_listings_paginated(self):
+        listing = Listing.objects.create(
+            slug="warm", style="Vertical", items_per_page=1
+        )
+        listing.categories.set([self.cat_a, self.cat_b])
+        listing.sites.set(Site.objects.all())
+        call_command(
+            "warm_listings", slugs=["warm"], pages=2, stdout=StringIO()
+        )
+
+        # Both pages are cached and they differ
+        t = template.Template("{% load listing_tags %}{% listing 'warm' %}")
+        with self.assertNumQueries(0):
+            pages = [
+                t.render(template.Context(
+                    {"request": RequestFactory().get("/", {"page": page})}
+                ))
+                for page in (1, 2)
+            ]
+        self.failUnless("ModelB Published" in pages[0])
+        self.failUnless("ModelA Published" in pages[1])
+
+    @override_settings(LISTING={"fragment_cache": 60})
+    def test_warm_listings_shared_slug(self):
+        listing = Listing.objects.create(slug="warm", style="Vertical")
+        listing.categories.set([self.cat_a])
+        listing.sites.set(Site.objects.all())
+        site = Site.objects.create(domain="other.com", name="other.com")
+        other = Listing.objects.create(slug="warm", style="Vertical")
+        other.categories.set([self.cat_b])
+        other.sites.set([site])
+        # A listing that can not render is reported and skipped
+        broken = Listing.objects.create(slug="warm-broken", style="Missing")
+        broken.sites.set(Site.objects.all())
+        out = StringIO()
+        err = StringIO()
+        call_command(
+            "warm_listings", slugs=["warm", "warm-broken"], stdout=out,
+            stderr=err
+        )
+        self.failUnless("warm-broken: failed, KeyError" in err.getvalue())
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[0].split(":")[0], "warm")
+        self.failUnless(lines[-2].startswith("Warmed 1 listings"))
+        self.assertEqual(lines[-1], "Failed to warm 1 listings")
+
+        # The listing of the current site is cached for its slug
+        t = template.Template("{% load listing_tags %}{% listing 'warm' %}")
+        request = RequestFactory().get("/", {"page": 1})
+        with self.assertNumQueries(0):
+            result = t.render(template.Context({"request": request}))
+        self.failUnless("ModelA Published" in result)
+        self.failIf("ModelB Published" in result)
+
+    def test_warm_listings_other_site(self):
+        site = Site.objects.create(domain="other.com", name="other.com")
+        with self.assertRaises(CommandError):
+            call_command("warm_listings", sites=[site.pk], stdout=StringIO())
+
+    def test_snapshots(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        listing = Listing.objects.create(slug="snapshot", style="Vertical")
+        listing.categories.set([self.cat_a])
+        listing.set_pinned([self.model_a])
+        out = StringIO()
+        call_command(
+            "export_listing_snapshots", directory=directory, summaries=True,
+            stdout=out
+        )
+        path = os.path.join(directory, "%s.json" % listing.id)
+        with open(path) as fp:
+            data = json.load(fp)
+        self.assertEqual(data["version"], listing.version)
+        self.assertEqual(data["items"], [self.model_a_published.id])
+        self.assertEqual(data["pinned"], [])
+        self.assertEqual(data["summaries"][0]["title"], "ModelA Published")
+
+        # Only changed listings are written
+        out = StringIO()
+        call_command(
+            "export_listing_snapshots", directory=directory, summaries=True,
+            stdout=out
+        )
+        self.failUnless("Wrote 0 of" in out.getvalue())
+
+        with override_settings(LISTING={"snapshot_dir": directory}):
+            self.assertEqual(load_snapshot(listing), data)
+            # The snapshot replaces the search
+            t = template.Template(
+                "{% load listing_tags %}{% listing 'snapshot' %}"
+            )
+            context = template.Context({"request": RequestFactory().get("/")})
+            with CaptureQueriesContext(connection) as captured:
+                result = t.render(context)
+            self.failUnless("ModelA Published" in result)
+            self.failIf([
+                q for q in captured.captured_queries
+                if '"primary_category_id" IN' in q["sql"]
+            ])
+
+            listing.set_content([self.model_b])
+            self.assertEqual(load_snapshot(listing), None)
+
+    def test_snapshots_paginated(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        listing = Listing.objects.create(
+            slug="snapshot", style="Vertical", items_per_page=1
+        )
+        listing.categories.set([self.cat_a, self.cat_b])
+        call_command(
+            "export_listing_snapshots", directory=directory, stdout=StringIO()
+        )
+
+        with override_settings(LISTING={"snapshot_dir": directory}):
+            # Only the items on the page are fetched
+            t = template.Template(
+                "{% load listing_tags %}{% listing 'snapshot' %}"
+            )
+            context = template.Context(
+                {"request": RequestFactory().get("/", {"page": 2})}
+            )
+            with CaptureQueriesContext(connection) as captured:
+                result = t.render(context)
+            self.failUnless("ModelA Published" in result)
+            self.failIf("ModelB Published" in result)
+            self.failIf([
+                q for q in captured.captured_queries
+                if q["sql"].count("WHEN") > 1
+            ])
+
+            # A snapshot is only valid for the site it was built for
+            self.failIf(load_snapshot(listing) is None)
+            site = Site.objects.create(domain="other.com", name="other.com")
+            with override_settings(SITE_ID=site.pk):
+                self.assertEqual(load_snapshot(listing), None)
+
+    def test_register_style(self):
+
+        @register
+        class Registered(AbstractBaseStyle):
+            template_name = "listing/templatetags/vertical.html"
+
+        self.addCleanup(list.remove, LISTING_CLASSES, Registered)
+        self.addCleanup(dict.__delitem__, LISTING_MAP, "Registered")
+        self.failUnless(LISTING_MAP["Registered"] is Registered)
+        self.failUnless(Registered in LISTING_CLASSES)
+        self.failUnless(
+            ("Registered", "Registered")
+            in list(Listing._meta.get_field("style").choices)
+        )
+
+    def test_autodiscover_threads(self):
+        started = threading.Event()
+        release = threading.Event()
+        discover = styles._discover
+
+        def slow_discover():
+            started.set()
+            release.wait(5)
+            discover()
+
+        self.addCleanup(setattr, styles, "_discover", discover)
+        self.addCleanup(styles._state.__setitem__, "discovered", True)
+        styles._discover = slow_discover
+        styles._state["discovered"] = False
+
+        first = threading.Thread(target=styles.autodiscover)
+        first.start()
+        started.wait(5)
+        # Another thread waits until the styles are populated
+        second = threading.Thread(target=styles.autodiscover)
+        second.start()
+        second.join(0.2)
+        self.failUnless(second.is_alive())
+        release.set()
+        first.join(5)
+        second.join(5)
+        self.failIf(second.is_alive())
+        self.failUnless(styles._state["discovered"])
+        self.failUnless("Vertical" in LISTING_MAP)
+
+    def test_len_and_exists(self):
+        listing = Listing.objects.create()
+        listing.content_types.set([
+            ContentType.objects.get_for_model(ModelA),
+            ContentType.objects.get_for_model(ModelB)
+        ])
+        listing.definition
+        with self.assertNumQueries(1) as context:
+            self.assertEqual(len(listing), 2)
+        self.failUnless("COUNT" in context.captured_queries[0]["sql"])
+        with self.assertNumQueries(1) as context:
+            self.failUnless(listing)
+        self.failUnless("LIMIT 1" in context.captured_queries[0]["sql"])
+
+        listing.count = 1
+        self.assertEqual(len(listing), 1)
+
+        listing = Listing.objects.create()
+        listing.set_content([self.model_a, self.model_a_published])
+        self.assertEqual(len(listing), 1)
+        self.failUnless(listing.exists())
+
+        listing = Listing.objects.create()
+        self.assertEqual(len(listing), 0)
+        self.failIf(listing.exists())
+        self.failIf(listing)
+
+    def test_no_deferred_fields(self):
+        listing = Listing.objects.create()
+        listing.content_types.set([
+            ContentType.objects.get_for_model(ModelA),
+            ContentType.objects.get_for_model(ModelB)
+        ])
+        listing.categories.set([self.cat_a, self.cat_b])
+        listing.definition
+        with self.assertNumQueries(1):
+            objs = list(listing.queryset)
+            titles = [o.title for o in objs]
+            [o.modified for o in objs]
+        self.assertEqual(len(titles), 4)
+        published = [o for o in objs if o.publish_on]
+        self.assertEqual(
+            published,
+            sorted(published, key=lambda o: o.publish_on, reverse=True)
+        )
+
     def test_slug_uniqueness(self):
         sites = Site.objects.all()
         listing = Listing.objects.create(title="tsu", slug="tsu")
@@ -208,4 +617,261 @@ class ModelsTestCase(TestCase):
         listing.sites.set([sites[0]])
         listing = Listing.objects.create(title="tsu", slug="tsu")
         with self.assertRaises(RuntimeError):
-            listing.sites.set([sites[0]])
+            with transaction.atomic():
+                listing.sites.set([sites[0]])
+        self.failIf(listing.sites.exists())
+
+    def test_slug_uniqueness_rename(self):
+        site = Site.objects.all()[0]
+        listing = Listing.objects.create(title="tsr", slug="tsr")
+        listing.sites.set([site])
+        other = Listing.objects.create(title="tsr other", slug="tsr-other")
+        other.sites.set([site])
+        other.slug = "tsr"
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                other.save()
+        listing.slug = "tsr-renamed"
+        listing.save()
+        other.save()
+        self.assertEqual(
+            set(ListingSiteSlug.objects.values_list("slug", flat=True)),
+            set(["tsr-renamed", "tsr"])
+        )
+        # Removing the site frees the slug
+        listing.sites.clear()
+        self.failIf(ListingSiteSlug.objects.filter(listing=listing).exists())
+
+    def test_slug_unchanged_save(self):
+        listing = Listing.objects.create(title="tsn", slug="tsn")
+        listing.sites.set(Site.objects.all())
+        # Saving without changing the slug leaves the site slugs alone
+        for obj in (listing, Listing.objects.get(id=listing.id)):
+            obj.title = "tsn changed"
+            with CaptureQueriesContext(connection) as captured:
+                obj.save()
+            self.failIf([
+                q for q in captured.captured_queries
+                if "listingsiteslug" in q["sql"]
+            ])
+        # A deferred slug is not known to be unchanged
+        obj = Listing.objects.defer("slug").get(id=listing.id)
+        obj.slug = "tsn-renamed"
+        obj.save()
+        self.assertEqual(
+            list(ListingSiteSlug.objects.filter(
+                listing=listing
+            ).values_list("slug", flat=True).distinct()),
+            ["tsn-renamed"]
+        )
+
+    def test_slug_migration_conflicts(self):
+        migration = import_module("listing.migrations.0005_listingsiteslug")
+        site = Site.objects.all()[0]
+        listing = Listing.objects.create(title="tsm", slug="tsm")
+        listing.sites.set([site])
+        migration.check_conflicts(apps, None)
+        # Rows written around the slug check make the migration fail
+        other = Listing.objects.create(title="tsm", slug="tsm")
+        Listing.sites.through.objects.bulk_create([
+            Listing.sites.through(listing=other, site=site)
+        ])
+        with self.assertRaises(RuntimeError) as cm:
+            migration.check_conflicts(apps, None)
+        self.failUnless(
+            "slug tsm on site %s: listings %s, %s" % (site.pk, listing.pk, other.pk)
+            in str(cm.exception)
+        )
+
+    def test_definition(self):
+        listing = Listing.objects.create()
+        listing.categories.set([self.cat_a])
+        listing.set_pinned([self.model_a])
+        listing = Listing.objects.get(id=listing.id)
+        list(listing.queryset)
+
+        # The definition is cached
+        listing = Listing.objects.get(id=listing.id)
+        with self.assertNumQueries(1):
+            qs = listing.queryset
+            self.assertEqual(
+                [o.id for o in qs], [self.model_a_published.id]
+            )
+
+        # Changes invalidate the definition
+        cat_c = Category.objects.create(title="CatC", slug="cat-c")
+        self.model_b.categories.add(cat_c)
+        cat_c.listing_categories.add(listing)
+        listing = Listing.objects.get(id=listing.id)
+        self.assertEqual(len(listing.queryset), 2)
+        cat_c.delete()
+        listing = Listing.objects.get(id=listing.id)
+        self.assertEqual(len(listing.queryset), 1)
+        listing.set_content([self.model_b])
+        self.assertEqual(
+            [o.id for o in listing.queryset], [self.model_b.id]
+        )
+
+    def test_get_page(self):
+        listing = Listing.objects.create()
+        listing.content_types.set([
+            ContentType.objects.get_for_model(ModelA),
+            ContentType.objects.get_for_model(ModelB)
+        ])
+        expected = [o.id for o in listing.queryset.order_by(
+            "-publish_on", "-created", "-id"
+        )]
+        self.assertEqual(len(expected), 4)
+        page = listing.get_page(limit=3, manager="objects")
+        self.assertEqual([o.id for o in page], expected[:3])
+        self.failUnless(page.has_next)
+        page = listing.get_page(
+            cursor=page.next_cursor, limit=3, manager="objects"
+        )
+        self.assertEqual([o.id for o in page], expected[3:])
+        self.failIf(page.has_next)
+
+        # Count caps the items across pages
+        listing.count = 2
+        page = listing.get_page(limit=3, manager="objects")
+        self.assertEqual([o.id for o in page], expected[:2])
+        self.failIf(page.has_next)
+
+    def test_get_page_content(self):
+        listing = Listing.objects.create()
+        listing.set_content([
+            self.model_b, self.model_a, self.model_a_published
+        ])
+        page = listing.get_page(limit=2, manager="objects")
+        self.assertEqual(
+            [o.id for o in page], [self.model_b.id, self.model_a.id]
+        )
+        page = listing.get_page(
+            cursor=page.next_cursor, limit=2, manager="objects"
+        )
+        self.assertEqual([o.id for o in page], [self.model_a_published.id])
+        self.failIf(page.has_next)
+
+    def test_get_page_invalid_cursor(self):
+        listing = Listing.objects.create()
+        with self.assertRaises(ValueError):
+            listing.get_page(cursor="junk")
+        # Values that do not fit the fields
+        listing.categories.set([self.cat_a])
+        for values in (["junk", None, 1], [{"a": 1}, None, 1], [None, None, []]):
+            with self.assertRaises(ValueError):
+                listing.get_page(cursor=encode_cursor(values, 1))
+        listing.set_content([self.model_a_published])
+        with self.assertRaises(ValueError):
+            listing.get_page(cursor=encode_cursor(["junk", 1], 1))
+
+    def test_leaf_classes(self):
+        listing = Listing.objects.create()
+        listing.set_content([
+            self.model_a, self.model_b, self.model_a_published,
+            self.model_b_published
+        ])
+        qs = with_leaf_classes(listing.queryset)
+        # Warm the content type cache
+        ContentType.objects.get_for_model(ModelA)
+        ContentType.objects.get_for_model(ModelB)
+
+        # One query for the listing, one per content type
+        with self.assertNumQueries(3):
+            objs = list(qs)
+            for obj in objs:
+                self.failUnless(obj.as_leaf_class() is obj)
+                obj.content_type.app_label
+        self.assertEqual(
+            set([o.__class__ for o in objs]), set([ModelA, ModelB])
+        )
+        self.assertEqual(len(objs), 4)
+
+    @override_settings(LISTING={"membership_index": True})
+    def test_membership_index(self):
+        listing = Listing.objects.create()
+        listing.categories.set([self.cat_a])
+        listing.set_pinned([self.model_a])
+        qs = listing.queryset
+        self.assertEqual(len(qs), 1)
+        self.failUnless(self.model_a_published.modelbase_obj in qs)
+        qs = listing.queryset_permitted
+        self.assertEqual(len(qs), 1)
+        self.failUnless(self.model_a_published.modelbase_obj in qs)
+
+        # Item gains and loses the category
+        self.model_b_published.categories.add(self.cat_a)
+        self.failUnless(
+            self.model_b_published.modelbase_obj in listing.queryset
+        )
+        self.model_b_published.categories.remove(self.cat_a)
+        self.failIf(self.model_b_published.modelbase_obj in listing.queryset)
+        self.cat_a.modelbase_set.add(self.model_b_published)
+        self.failUnless(
+            self.model_b_published.modelbase_obj in listing.queryset
+        )
+        self.cat_a.modelbase_set.clear()
+        self.assertEqual(len(listing.queryset), 0)
+
+        # Listing criteria change
+        listing.categories.set([self.cat_b])
+        self.assertEqual(len(listing.queryset), 2)
+        self.failUnless(self.model_b.modelbase_obj in listing.queryset)
+
+    @override_settings(LISTING={"membership_index": True})
+    def test_membership_index_order(self):
+        cat = Category.objects.create(title="Ties", slug="ties")
+        items = []
+        for n in range(3):
+            obj = ModelA.objects.create(title="Tie %s" % n, slug="tie-%s" % n)
+            obj.categories.set([cat])
+            items.append(obj)
+        listing = Listing.objects.create()
+        listing.categories.set([cat])
+        listing.build_membership()
+        ModelBase.objects.filter(id__in=[o.id for o in items]).update(
+            publish_on=None, created=items[0].created
+        )
+        ListingMembership.objects.filter(listing=listing).update(
+            publish_on=None, created=items[0].created
+        )
+        # Ties are broken the same way as without the index
+        with override_settings(LISTING={}):
+            expected = [o.id for o in listing.queryset]
+        self.assertEqual([o.id for o in listing.queryset], expected)
+        self.assertEqual(expected, sorted(expected, reverse=True))
+
+    @override_settings(LISTING={"membership_index": True})
+    def test_membership_index_primary_category(self):
+        listing = Listing.objects.create()
+        listing.categories.set([self.cat_b])
+        self.model_a.primary_category = self.cat_b
+        self.model_a.save()
+        self.failUnless(self.model_a.modelbase_obj in listing.queryset)
+        self.model_a.primary_category = None
+        self.model_a.save()
+        self.failIf(self.model_a.modelbase_obj in listing.queryset)
+
+
+class CommitTestCase(TransactionTestCase):
+    # Commit callbacks only run outside of TestCase
+
+    def setUp(self):
+        super(CommitTestCase, self).setUp()
+        cache.clear()
+
+    def test_invalidate_on_commit(self):
+        category = Category.objects.create(title="Commit", slug="commit")
+        listing = Listing.objects.create(slug="commit")
+        with transaction.atomic():
+            listing.categories.set([category])
+            # A request that reads the old rows before the commit
+            stale = _build_definitions([Listing.objects.get(pk=listing.pk)])
+            cache.set(_get_definition_key(listing.pk), stale[listing.pk])
+            version = listing.version
+        self.assertEqual(cache.get(_get_definition_key(listing.pk)), None)
+        self.assertNotEqual(listing.version, version)
+        self.assertEqual(
+            Listing.objects.get(pk=listing.pk).definition["categories"],
+            [category.pk]
+        )
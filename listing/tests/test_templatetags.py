@@ -1,16 +1,26 @@
 import os
+import shutil
+import tempfile
 
 from django import template
+from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.sites.models import Site
-from django.test import TestCase
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.test.client import Client, RequestFactory
 
 from category.models import Category
+from layers import build_layer_stacks, reset_layer_stacks
 
 from listing.models import Listing
+from listing.styles import LISTING_MAP, _templates
+from listing.templatetags.listing_tags import _get_fragment_key
 from listing.tests.models import ModelA
+from listing.views import ListingDetail
 
 
 RES_DIR = os.path.join(os.path.dirname(__file__), "res")
@@ -39,6 +49,11 @@ class TemplateTagsTestCase(TestCase):
         obj.sites.set(Site.objects.all())
         cls.model_a_published = obj
 
+    def setUp(self):
+        super(TemplateTagsTestCase, self).setUp()
+        # Listing ids may be reused across tests
+        cache.clear()
+
     def common(self, style, category=False):
         l = style.lower()
         listing = Listing.objects.create(slug="listing-%s" % l, style=style)
@@ -64,3 +79,206 @@ class TemplateTagsTestCase(TestCase):
 
     def test_listing_promo(self):
         self.common("Promo")
+
+    def test_get_listing_page(self):
+        listing = Listing.objects.create(slug="listing-page", style="Vertical")
+        listing.content_types.set([ContentType.objects.get_for_model(ModelA)])
+        t = template.Template("{% load listing_tags %}"
+            + "{% get_listing_page 'listing-page' as 'page' %}"
+            + "{% for object in page %}{{ object.title }}{% endfor %}"
+            + "{{ page.has_next }}"
+        )
+        result = t.render(template.Context({
+            "request": RequestFactory().get("/", {"cursor": "junk"})
+        }))
+        self.failUnless("ModelA Published" in result)
+        self.failUnless("False" in result)
+
+    def test_batch(self):
+        for n in range(3):
+            listing = Listing.objects.create(
+                slug="listing-batch-%s" % n, style="Horizontal"
+            )
+            listing.content_types.set(
+                [ContentType.objects.get_for_model(ModelA)]
+            )
+        cache.clear()
+        t = template.Template("""{% load listing_tags %}
+            {% listing 'listing-batch-0' %}
+            {% listing 'listing-batch-1' %}
+            {% listing slug %}
+            {% get_listing_queryset 'listing-batch-0' as 'qs' %}
+            {% listing 'listing-batch-missing' %}"""
+        )
+        context = template.Context({
+            "request": RequestFactory().get("/"),
+            "slug": u"listing-batch-2"
+        })
+        with CaptureQueriesContext(connection) as captured:
+            result = t.render(context)
+        self.failUnless(result.count("ModelA Published") >= 3)
+        queries = [q["sql"] for q in captured.captured_queries]
+        # One lookup for all listings and one query per relation for all
+        # definitions.
+        self.assertEqual(
+            len([q for q in queries if 'FROM "listing_listing"' in q]), 1
+        )
+        self.assertEqual(
+            len([q for q in queries if "listing_content_types" in q]), 1
+        )
+
+    def test_style_template(self):
+        listing = Listing.objects.create(slug="listing-st", style="Vertical")
+        listing.set_content([self.model_a_published])
+        style = LISTING_MAP["Vertical"](listing)
+        # Templates are not cached in debug mode
+        self.failIf(style.get_template() is style.get_template())
+
+        templates = [dict(settings.TEMPLATES[0])]
+        templates[0]["OPTIONS"] = dict(templates[0]["OPTIONS"], debug=False)
+        with override_settings(TEMPLATES=templates):
+            self.addCleanup(_templates.clear)
+            self.failUnless(style.get_template() is style.get_template())
+            context = template.Context({
+                "request": RequestFactory().get("/"), "foo": "bar"
+            })
+            result = style.render(context)
+            self.failUnless("ModelA Published" in result)
+            # The context is left as it was
+            self.assertEqual(context.flatten()["foo"], "bar")
+            self.failIf("object_list" in context)
+
+    def test_style_template_layers(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        for layer in ("basic", "web"):
+            path = os.path.join(directory, layer, "listing", "templatetags")
+            os.makedirs(path)
+            with open(os.path.join(path, "vertical.html"), "w") as fp:
+                fp.write(layer)
+        templates = [{
+            "BACKEND": "django.template.backends.django.DjangoTemplates",
+            "DIRS": [directory],
+            "OPTIONS": {
+                "debug": False,
+                "loaders": ["layers.loaders.filesystem.Loader"]
+            }
+        }]
+        listing = Listing.objects.create(slug="listing-stl", style="Vertical")
+        style = LISTING_MAP["Vertical"](listing)
+        self.addCleanup(_templates.clear)
+        self.addCleanup(reset_layer_stacks)
+        with override_settings(TEMPLATES=templates):
+            # Each layer gets its own template
+            for layer in ("basic", "web", "basic"):
+                with override_settings(
+                    LAYERS={"tree": ["basic", ["web"]], "current": layer}
+                ):
+                    reset_layer_stacks()
+                    build_layer_stacks()
+                    self.assertEqual(
+                        style.get_template().render(template.Context()),
+                        layer
+                    )
+
+    def test_listing_detail_no_etag(self):
+        listing = Listing.objects.create(slug="listing-cg", style="Vertical")
+        listing.set_content([self.model_a_published])
+        # The page may differ per user, so it is not answered with a 304
+        view = ListingDetail.as_view(
+            template_name="listing/templatetags/vertical.html"
+        )
+        response = view(RequestFactory().get("/listing-cg/"), slug="listing-cg")
+        self.assertEqual(response.status_code, 200)
+        self.failIf(response.has_header("ETag"))
+
+    @override_settings(LISTING={"fragment_cache": 60})
+    def test_fragment_cache(self):
+        listing = Listing.objects.create(
+            title="Fragments", slug="listing-fc", style="Vertical"
+        )
+        listing.categories.set([self.cat_a])
+        t = template.Template("{% load listing_tags %}{% listing 'listing-fc' %}")
+        context = template.Context({"request": RequestFactory().get("/")})
+        self.failUnless("ModelA Published" in t.render(context))
+        with self.assertNumQueries(0):
+            self.failUnless("ModelA Published" in t.render(context))
+
+        # Another page is a different fragment
+        other = template.Context({"request": RequestFactory().get("/?page=2")})
+        with CaptureQueriesContext(connection) as captured:
+            t.render(other)
+        self.failUnless(len(captured))
+
+        # So is any other query string since pagination links carry it over
+        other = template.Context({"request": RequestFactory().get("/?foo=1")})
+        with CaptureQueriesContext(connection) as captured:
+            t.render(other)
+        self.failUnless(len(captured))
+
+        # And another layer
+        key = _get_fragment_key(
+            context, "listing-fc", listing.pk, "Vertical", False
+        )
+        with override_settings(LAYERS={"current": "web"}):
+            self.assertNotEqual(
+                _get_fragment_key(
+                    context, "listing-fc", listing.pk, "Vertical", False
+                ),
+                key
+            )
+
+        # Saving an affected item
+        self.model_a_published.title = "ModelA Edited"
+        self.model_a_published.save()
+        self.failUnless("ModelA Edited" in t.render(context))
+
+        # Editing the curated items
+        obj = ModelA.objects.create(title="ModelA Curated", slug="model-a-c")
+        obj.publish()
+        obj.sites.set(Site.objects.all())
+        listing.set_content([obj])
+        result = t.render(context)
+        self.failUnless("ModelA Curated" in result)
+        self.failIf("ModelA Edited" in result)
+
+        # Editing the listing
+        listing.title = "Fragments Edited"
+        listing.save()
+        self.failUnless("Fragments Edited" in t.render(context))
+
+        # Renaming the listing
+        listing.slug = "listing-fc-renamed"
+        listing.save()
+        self.assertEqual(t.render(context), "")
+
+    @override_settings(CACHES={
+        "default": {
+            "BACKEND": "django.core.cache.backends.dummy.DummyCache"
+        }
+    })
+    def test_query_count_independent_of_items(self):
+        listing = Listing.objects.create(slug="listing-qc", style="Vertical")
+        listing.set_content([self.model_a_published])
+        t = template.Template("{% load listing_tags %}{% listing 'listing-qc' %}")
+        context = template.Context({"request": RequestFactory().get("/")})
+        # Warm the content type cache
+        t.render(context)
+        t.render(context)
+        with CaptureQueriesContext(connection) as before:
+            t.render(context)
+
+        items = [self.model_a_published]
+        for n in range(3):
+            obj = ModelA.objects.create(
+                title="ModelA More %s" % n, slug="model-a-m-%s" % n
+            )
+            obj.publish()
+            obj.categories.set([self.cat_a])
+            obj.sites.set(Site.objects.all())
+            items.append(obj)
+            listing.set_content(items)
+        with CaptureQueriesContext(connection) as after:
+            result = t.render(context)
+        self.failUnless("ModelA More 2" in result)
+        self.assertEqual(len(before), len(after))
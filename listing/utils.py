@@ -0,0 +1,284 @@
+import hashlib
+from functools import wraps
+from itertools import islice
+
+try:
+    import asyncio
+except ImportError:
+    # Python 2
+    asyncio = None
+
+from django.contrib.contenttypes.models import ContentType
+from django.contrib.sites.shortcuts import get_current_site
+from django.db import close_old_connections
+from django.db.models.fields.related_descriptors import \
+    ReverseOneToOneDescriptor
+from django.db.models import prefetch_related_objects
+from django.db.models.query import ModelIterable, QuerySet
+from django.utils.encoding import force_bytes
+from django.views.decorators.http import condition
+
+from crum import get_current_request, set_current_request
+from jmbo.models import ModelBase
+from layers import get_current_layer
+
+
+def resolve_leaf_classes(objs, select_related=(), prefetch_related=()):
+    """Return the leaf class instances for objs in the same order. One query
+    is needed per distinct content type instead of one per item. The related
+    lookups are applied to the leaf instances."""
+    objs = list(objs)
+
+    # Avoid a query per item if content_type is deferred
+    deferred = [o.pk for o in objs if "content_type" in o.get_deferred_fields()]
+    content_type_ids = dict(ModelBase.objects.filter(id__in=deferred)\
+        .values_list("id", "content_type_id")) if deferred else {}
+
+    leaves = {}
+    ids_by_type = {}
+    for obj in objs:
+        content_type_id = content_type_ids.get(obj.pk, None) \
+            or obj.content_type_id
+        if content_type_id is None:
+            continue
+        model = ContentType.objects.get_for_id(content_type_id).model_class()
+        if (model is None) or (model is ModelBase):
+            continue
+        if obj.__class__ is model:
+            leaves[obj.pk] = obj
+        else:
+            ids_by_type.setdefault(content_type_id, []).append(obj.pk)
+
+    for content_type_id, ids in ids_by_type.items():
+        content_type = ContentType.objects.get_for_id(content_type_id)
+        q = content_type.model_class().objects.filter(id__in=ids)
+        if select_related:
+            q = q.select_related(*select_related)
+        for leaf in q:
+            leaf.content_type = content_type
+            leaves[leaf.pk] = leaf
+
+    result = []
+    for obj in objs:
+        leaf = leaves.get(obj.pk, obj)
+        if leaf is not obj:
+            # Carry over dynamically added attributes like as_leaf_class does
+            if hasattr(obj, "distance"):
+                leaf.distance = obj.distance
+        _prime_as_leaf_class(leaf)
+        result.append(leaf)
+
+    if prefetch_related:
+        prefetch_related_objects(result, *prefetch_related)
+    return result
+
+
+def _prime_as_leaf_class(obj):
+    # ModelBase.as_leaf_class looks up an attribute named after the lowercase
+    # class name and otherwise queries for the leaf. Provide the attribute so
+    # templates calling as_leaf_class on a leaf get it for free.
+    name = (obj.class_name or "").lower()
+    if not name or (obj.__class__.__name__.lower() != name):
+        return
+    descriptor = getattr(obj.__class__, name, None)
+    if isinstance(descriptor, ReverseOneToOneDescriptor):
+        # The parent link accessor is inherited by the leaf class
+        related = descriptor.related
+        if hasattr(related, "set_cached_value"):
+            related.set_cached_value(obj, obj)
+        else:
+            setattr(obj, related.get_cache_name(), obj)
+    elif descriptor is None:
+        obj.__dict__[name] = obj
+
+
+class LeafClassIterable(ModelIterable):
+    """Yields leaf class instances. Leaf classes are fetched in batches."""
+    batch_size = 100
+    select_related = ()
+    prefetch_related = ()
+
+    def __iter__(self):
+        objs = super(LeafClassIterable, self).__iter__()
+        while True:
+            batch = list(islice(objs, self.batch_size))
+            if not batch:
+                break
+            for obj in resolve_leaf_classes(
+                batch, self.select_related, self.prefetch_related
+            ):
+                yield obj
+
+
+_iterable_classes = {}
+
+
+def with_leaf_classes(queryset, select_related=(), prefetch_related=()):
+    """Return a copy of a ModelBase queryset that yields leaf class instances
+    with the related lookups applied. Since this happens as the queryset is
+    evaluated only the current slice is affected. Anything else is returned
+    unchanged."""
+    if isinstance(queryset, QuerySet) \
+        and issubclass(queryset.model, ModelBase) \
+        and issubclass(queryset._iterable_class, ModelIterable):
+        # The iterable class survives cloning, so it carries the lookups
+        key = (tuple(select_related), tuple(prefetch_related))
+        if key not in _iterable_classes:
+            _iterable_classes[key] = type(
+                str("LeafClassIterable"),
+                (LeafClassIterable,),
+                {"select_related": key[0], "prefetch_related": key[1]}
+            )
+        queryset = queryset.all()
+        queryset._iterable_class = _iterable_classes[key]
+    return queryset
+
+
+def _get_loop():
+    if asyncio is None:
+        raise RuntimeError("The async API requires Python 3")
+    return asyncio.get_event_loop()
+
+
+def run_in_executor(func, *args):
+    """Return an awaitable for the result of func. It runs in the default
+    executor of the event loop so queries do not block the loop. The current
+    request of the calling thread is the current request while it runs, so
+    permitted items are filtered by its site and layer."""
+    request = get_current_request()
+
+    def run():
+        # Threads hold on to their connection. Honour CONN_MAX_AGE.
+        close_old_connections()
+        previous = get_current_request()
+        set_current_request(request)
+        try:
+            return func(*args)
+        finally:
+            set_current_request(previous)
+            close_old_connections()
+
+    return _get_loop().run_in_executor(None, run)
+
+
+def chain(future, func):
+    """Return an awaitable for func applied to the result of future. func
+    runs in the event loop thread."""
+    result = _get_loop().create_future()
+
+    def done(f):
+        if result.cancelled():
+            return
+        if f.cancelled():
+            result.cancel()
+        elif f.exception() is not None:
+            result.set_exception(f.exception())
+        else:
+            try:
+                result.set_result(func(f.result()))
+            except Exception as exc:
+                result.set_exception(exc)
+
+    future.add_done_callback(done)
+    return result
+
+
+class ItemList(list):
+    """A list of fetched items providing the parts of the queryset API that
+    style templates use."""
+
+    def exists(self):
+        return bool(self)
+
+    def count(self):
+        return len(self)
+
+
+class PageList(ItemList):
+    """The fetched items of one page of a longer list. Slicing is relative to
+    the full list and count returns its length, so a paginator can page
+    through it without the other items being fetched."""
+
+    def __init__(self, items, offset, total):
+        super(PageList, self).__init__(items)
+        self.offset = offset
+        self.total = total
+
+    def exists(self):
+        return self.total > 0
+
+    def count(self):
+        return self.total
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start = max((index.start or 0) - self.offset, 0)
+            stop = index.stop
+            if stop is not None:
+                stop = max(stop - self.offset, 0)
+            return ItemList(list.__getitem__(self, slice(start, stop)))
+        return list.__getitem__(self, index - self.offset)
+
+    def __getslice__(self, start, stop):
+        # Python 2 slices lists through __getslice__
+        return self.__getitem__(slice(start, stop))
+
+
+class AsyncIterator(object):
+    """Asynchronous iterator over the list returned by func. The list is
+    fetched in an executor on the first step."""
+
+    def __init__(self, func):
+        self.func = func
+        self.iterator = None
+
+    def __aiter__(self):
+        return self
+
+    def _next(self, li=None):
+        if li is not None:
+            self.iterator = iter(li)
+        try:
+            return next(self.iterator)
+        except StopIteration:
+            raise StopAsyncIteration
+
+    def __anext__(self):
+        if self.iterator is None:
+            return chain(run_in_executor(self.func), self._next)
+        future = _get_loop().create_future()
+        try:
+            future.set_result(self._next())
+        except StopAsyncIteration as exc:
+            future.set_exception(exc)
+        return future
+
+
+def get_etag(request, listing):
+    """Return an ETag for a response that shows listing. It changes with the
+    version of the listing and varies by site, layer, path and accepted
+    format."""
+    return '"%s"' % hashlib.md5(force_bytes("%s-%s-%s-%s-%s" % (
+        listing.version,
+        get_current_site(request).pk,
+        get_current_layer(request),
+        request.get_full_path(),
+        request.META.get("HTTP_ACCEPT", "")
+    ))).hexdigest()
+
+
+def listing_condition(func):
+    """Decorate a view method to answer conditional GET requests for the
+    listing returned by the get_object method of the view. A 304 response
+    costs the listing lookup and a cache hit for its version."""
+
+    @wraps(func)
+    def inner(view, request, *args, **kwargs):
+        listing = view.get_object()
+        return condition(
+            etag_func=lambda request: get_etag(request, listing),
+            last_modified_func=lambda request: listing.last_modified
+        )(lambda request: func(view, request, *args, **kwargs))(request)
+
+    return inner
+
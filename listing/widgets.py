@@ -0,0 +1,61 @@
+from django import forms
+from django.utils.encoding import force_text
+
+from jmbo.models import ModelBase
+
+
+def get_item_label(obj):
+    """A label that, unlike str(obj), needs no further queries"""
+    if obj.subtitle:
+        return "%s - %s" % (obj.title, obj.subtitle)
+    return obj.title
+
+
+class ItemSelectWidget(forms.SelectMultiple):
+    """Ordered multiple select that only renders the selected items. Other
+    items are found through the search view at search_url."""
+
+    def __init__(self, search_url="", attrs=None):
+        super(ItemSelectWidget, self).__init__(attrs)
+        self.search_url = search_url
+
+    class Media:
+        js = ("admin/listing/js/item_select.js",)
+
+    def render(self, name, value, attrs=None, renderer=None):
+        # Do not iterate over every item on the site
+        ids = [force_text(getattr(v, "pk", v)) for v in (value or [])]
+        objs = dict(
+            (force_text(obj.pk), obj)
+            for obj in ModelBase.objects.filter(id__in=ids).only(
+                "id", "title", "subtitle"
+            )
+        )
+        self.choices = [
+            (pk, get_item_label(objs[pk])) for pk in ids if pk in objs
+        ]
+
+        attrs = dict(attrs or {})
+        attrs["class"] = " ".join(
+            c for c in (attrs.get("class"), "listing-item-select") if c
+        )
+        attrs["data-search-url"] = force_text(self.search_url)
+        if renderer is None:
+            # Django 1.10
+            return super(ItemSelectWidget, self).render(name, ids, attrs)
+        return super(ItemSelectWidget, self).render(
+            name, ids, attrs, renderer
+        )
+
+
+class OrderedModelMultipleChoiceField(forms.ModelMultipleChoiceField):
+    """Return the selected items as a list in the submitted order instead of
+    a queryset"""
+
+    def clean(self, value):
+        queryset = super(OrderedModelMultipleChoiceField, self).clean(value)
+        objs = dict((force_text(obj.pk), obj) for obj in queryset)
+        return [
+            objs[force_text(pk)] for pk in (value or [])
+            if force_text(pk) in objs
+        ]